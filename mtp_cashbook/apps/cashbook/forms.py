@@ -1,69 +1,250 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+import functools
+import hashlib
 from math import ceil
 from urllib.parse import urlencode
 
 from django import forms
+from django.conf import settings
 from django.contrib import messages
+from django.core import signing
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.utils.functional import cached_property
 from django.utils.dateformat import format as format_date
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext, gettext_lazy, ngettext
 from form_error_reporting import GARequestErrorReportingMixin
-from mtp_common.api import retrieve_all_pages_for_path
 from mtp_common.auth.api_client import get_api_session
 
-from .tasks import credit_selected_credits_to_nomis
+from mtp_cashbook.records import Credit
+from mtp_cashbook.result_cache import (
+    cache_results, get_cached_results, invalidate_cached_results, prefetch_results,
+)
+from mtp_cashbook.utils import copy_api_session, iterate_all_pages, refresh_api_token
+from .progress import CreditingProgress
+from .tasks import credit_selected_credits_to_nomis, pack_credit_batch
 from .templatetags.credits import parse_date_fields
 
 MANUALLY_CREDITED_LOG_LEVEL = 21
 
 
+def get_credit_snapshot(request, resolution, ordering):
+    """
+    Loads all credit_pending credits with a given resolution as choices once per request
+    so that validating, saving and re-rendering forms share the same list
+    """
+    snapshots = getattr(request, 'credit_snapshots', None)
+    if snapshots is None:
+        snapshots = request.credit_snapshots = {}
+    key = (resolution, ordering)
+    if key not in snapshots:
+        credits = iterate_all_pages(
+            get_api_session(request), 'credits/', status='credit_pending', resolution=resolution,
+            ordering=ordering
+        )
+        snapshots[key] = [
+            (credit.id, credit) for credit in map(Credit, credits)
+        ]
+    return snapshots[key]
+
+
+def has_credit_snapshot(request, resolution, ordering):
+    return (resolution, ordering) in getattr(request, 'credit_snapshots', {})
+
+
 class ProcessNewCreditsForm(GARequestErrorReportingMixin, forms.Form):
     credits = forms.MultipleChoiceField(choices=(), required=False)
+    select_all_pages = forms.BooleanField(required=False)
+    # signed digest of the ids of all credits that the user was shown when selecting all pages
+    select_all_digest = forms.CharField(required=False, widget=forms.HiddenInput)
 
-    def __init__(self, request, ordering='-received_at', *args, **kwargs):
+    def __init__(self, request, ordering='-received_at', page=1, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.request = request
         self.user = request.user
         self.session = get_api_session(request)
         self.ordering = ordering
+        self.page = page
+        self.page_size = settings.NEW_CREDITS_PAGE_SIZE
+        self.pagination = {
+            'page': 1,
+            'count': 0,
+            'page_count': 0,
+        }
 
-        self.fields['credits'].choices = self.credit_choices
+        # all credits are only loaded when choices are needed so that a page of credits can be shown without them
+        self.fields['credits'].choices = lambda: self.credit_choices
 
     def _request_all_credits(self):
-        return retrieve_all_pages_for_path(
-            self.session, 'credits/', status='credit_pending', resolution='pending',
-            ordering=self.ordering
-        )
+        return get_credit_snapshot(self.request, 'pending', self.ordering)
 
-    def clean_credits(self):
-        credits = self.cleaned_data.get('credits', [])
-        if not credits:
+    def clean(self):
+        if self.cleaned_data.get('select_all_pages'):
+            credits = dict(self.credit_choices)
+            if load_select_all_digest(self.cleaned_data.get('select_all_digest')) != self.summary['digest']:
+                # credits have arrived or been processed since the user loaded the page
+                self.add_error(None, gettext('New credits have changed since you loaded this page, '
+                                             'please check them and try again'))
+                return super().clean()
+            self.cleaned_data['credits'] = [str(credit_id) for credit_id in credits]
+        if not self.cleaned_data.get('credits'):
             self.add_error(None, gettext('Only click ‘Credit to NOMIS’ when you’ve selected credits'))
-        return credits
+        return super().clean()
 
     @cached_property
     def credit_choices(self):
         """
         Gets the credits currently available the user.
         """
-        credits = self._request_all_credits()
+        return self._request_all_credits()
+
+    @property
+    def paginated(self):
+        return self.page_size > 0
+
+    @cached_property
+    def page_credit_choices(self):
+        """
+        Gets the credits on the current page or all credits if the queue is not paginated
+        """
+        if not self.paginated:
+            self.pagination = {
+                'page': 1,
+                'count': len(self.credit_choices),
+                'page_count': 1,
+            }
+            return self.credit_choices
+
+        page = max(1, self.page)
+        response = self.session.get('credits/', params={
+            'status': 'credit_pending', 'resolution': 'pending', 'ordering': self.ordering,
+            'offset': (page - 1) * self.page_size, 'limit': self.page_size,
+        }).json()
+        count = response.get('count', 0)
+        self.pagination = {
+            'page': page,
+            'count': count,
+            'page_count': int(ceil(count / self.page_size)),
+        }
         return [
-            (t['id'], t) for t in parse_date_fields(credits)
+            (credit.id, credit) for credit in map(Credit, response.get('results', []))
         ]
 
+    @cached_property
+    def summary(self):
+        """
+        Count, total amount, oldest and latest received dates and digest of the ids of all new credits;
+        when the queue is paginated, the summary is kept in the result cache so that moving between pages
+        does not load all credits each time, but it is always recalculated once all credits have been loaded,
+        as they are when submitting
+        """
+        if self.paginated and not has_credit_snapshot(self.request, 'pending', self.ordering):
+            page_credit_choices = self.page_credit_choices
+            if len(page_credit_choices) >= self.pagination['count']:
+                # the page being shown has all new credits
+                return summarise_new_credits(dict(page_credit_choices).values())
+            summary = get_cached_results(self.user, 'new-credits-summary', {}, 1)
+            if summary is not None:
+                return summary
+        summary = summarise_new_credits(dict(self.credit_choices).values())
+        if self.paginated:
+            cache_results(self.user, 'new-credits-summary', {}, 1, summary)
+        return summary
+
+    @property
+    def signed_digest(self):
+        return dump_select_all_digest(self.summary['digest'])
+
     def save(self):
         credit_ids = [int(c_id) for c_id in set(self.cleaned_data['credits'])]
         credits = dict(self.credit_choices)
 
         self.session.post('credits/batches/', json={'credits': credit_ids})
+        # progress of any previous batch is replaced so that the new batch's progress is known before crediting starts
+        progress = CreditingProgress(self.user.pk)
+        progress.clear()
+        progress.start(len(credit_ids))
         credit_selected_credits_to_nomis(
             user=self.request.user, user_session=self.request.session,
-            selected_credit_ids=credit_ids, credits=credits
+            selected_credit_ids=credit_ids,
+            credit_batch=pack_credit_batch(credits[credit_id] for credit_id in credit_ids if credit_id in credits),
         )
 
 
+def summarise_new_credits(credits):
+    summary = {
+        'count': 0,
+        'amount': 0,
+        'oldest_received_at': None,
+        'latest_received_at': None,
+    }
+    credit_ids = []
+    for credit in credits:
+        summary['count'] += 1
+        summary['amount'] += credit['amount']
+        credit_ids.append(credit['id'])
+        received_at = credit.get('received_at')
+        if not received_at:
+            continue
+        if summary['oldest_received_at'] is None or received_at < summary['oldest_received_at']:
+            summary['oldest_received_at'] = received_at
+        if summary['latest_received_at'] is None or received_at > summary['latest_received_at']:
+            summary['latest_received_at'] = received_at
+    summary['digest'] = get_credit_ids_digest(credit_ids)
+    return summary
+
+
+def get_credit_ids_digest(credit_ids):
+    """
+    Identifies a set of credits so that a submission can be checked against exactly those the user was shown
+    """
+    credit_ids = ','.join(map(str, sorted(credit_ids)))
+    return hashlib.sha256(credit_ids.encode()).hexdigest()
+
+
+def dump_select_all_digest(digest):
+    return signing.dumps(digest, salt='new-credits-select-all')
+
+
+def load_select_all_digest(value):
+    if not value:
+        return None
+    try:
+        return signing.loads(value, salt='new-credits-select-all')
+    except signing.BadSignature:
+        return None
+
+
+def summarise_manual_credits(credit_choices, user_id):
+    """
+    Splits manual credits into those owned by the user and others
+    while counting them, collecting others' names and finding the oldest date others set
+    """
+    summary = {
+        'count': 0,
+        'owned': [],
+        'unowned': [],
+        'other_owners': set(),
+        'unowned_oldest_date': None,
+    }
+    for credit_id, credit in credit_choices:
+        summary['count'] += 1
+        if credit['owner'] == user_id:
+            summary['owned'].append((credit_id, credit))
+            continue
+        summary['unowned'].append((credit_id, credit))
+        summary['other_owners'].add(credit['owner_name'])
+        set_manual_at = credit['set_manual_at']
+        if summary['unowned_oldest_date'] is None or (
+                set_manual_at is not None and summary['unowned_oldest_date'] > set_manual_at):
+            summary['unowned_oldest_date'] = set_manual_at
+    summary['other_owners'] = sorted(summary['other_owners'])
+    return summary
+
+
 class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
     credit = forms.ChoiceField(choices=(), required=False)
 
@@ -74,13 +255,10 @@ class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
         self.session = get_api_session(request)
         self.ordering = ordering
 
-        self.fields['credit'].choices = self.credit_choices
+        self.fields['credit'].choices = lambda: self.credit_choices
 
     def _request_all_credits(self):
-        return retrieve_all_pages_for_path(
-            self.session, 'credits/', status='credit_pending', resolution='manual',
-            ordering=self.ordering
-        )
+        return get_credit_snapshot(self.request, 'manual', self.ordering)
 
     def clean_credit(self):
         prefix = 'submit_manual_'
@@ -88,7 +266,7 @@ class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
             for key in self.request.POST:
                 if key.startswith(prefix):
                     credit_id = int(key[len(prefix):])
-                    if not self.credit_choices or credit_id not in next(zip(*self.credit_choices)):
+                    if not self.credit_exists(credit_id):
                         raise forms.ValidationError(
                             gettext_lazy('That credit cannot be manually credited'), code='invalid'
                         )
@@ -99,10 +277,33 @@ class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
         """
         Gets the credits currently available the user.
         """
-        credits = self._request_all_credits()
-        return [
-            (t['id'], t) for t in parse_date_fields(credits)
-        ]
+        return self._request_all_credits()
+
+    @cached_property
+    def credit_index(self):
+        """
+        Credits by id, built once from the request's snapshot
+        """
+        return dict(self.credit_choices)
+
+    def credit_exists(self, credit_id):
+        """
+        Checks that a credit is still awaiting manual crediting using the request's snapshot if already loaded
+        or otherwise by looking up just that credit so that crediting one does not load the whole list
+        """
+        if has_credit_snapshot(self.request, 'manual', self.ordering):
+            return credit_id in self.credit_index
+        response = self.session.get('credits/', params={
+            'pk': credit_id, 'status': 'credit_pending', 'resolution': 'manual', 'limit': 1,
+        }).json()
+        return any(credit['id'] == credit_id for credit in response.get('results', []))
+
+    @cached_property
+    def summary(self):
+        """
+        Manual credits owned by the user and others, others' names and the oldest date others set
+        """
+        return summarise_manual_credits(self.credit_choices, self.user.pk)
 
     def save(self):
         credit_id = int(self.cleaned_data['credit'])
@@ -110,6 +311,7 @@ class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
             'credits/actions/credit/',
             json=[{'id': credit_id, 'credited': True}]
         )
+        invalidate_cached_results(self.user)
         manually_credited = 1
         try:
             manually_credited += int(self.request.GET.get('manually_credited'))
@@ -121,6 +323,28 @@ class ProcessManualCreditsForm(GARequestErrorReportingMixin, forms.Form):
         return credit_id
 
 
+def dump_processed_credits_cursor(page, key):
+    batch_date, skip = key
+    return signing.dumps([page, batch_date.isoformat(), skip], salt='processed-credits-cursor')
+
+
+def load_processed_credits_cursor(cursor):
+    """
+    Returns the cursor's page number and its (date, number of that day's batches to skip) key
+    marking the start of the page; the first page has no key
+    """
+    if not cursor:
+        return 1, None
+    try:
+        page, batch_date, skip = signing.loads(cursor, salt='processed-credits-cursor')
+        page, batch_date, skip = int(page), parse_date(batch_date), int(skip)
+    except (signing.BadSignature, TypeError, ValueError):
+        return 1, None
+    if page < 2 or batch_date is None or skip < 0:
+        return 1, None
+    return page, (batch_date, skip)
+
+
 class FilterProcessedCreditsListForm(GARequestErrorReportingMixin, forms.Form):
     start = forms.DateField(label=gettext_lazy('From date'),
                             help_text=gettext_lazy('For example, 13/6/2017'),
@@ -129,6 +353,7 @@ class FilterProcessedCreditsListForm(GARequestErrorReportingMixin, forms.Form):
                           help_text=gettext_lazy('For example, 15/6/2017'),
                           required=False)
     page = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    cursor = forms.CharField(required=False, widget=forms.HiddenInput)
 
     page_size = 20
     renames = (
@@ -180,27 +405,146 @@ class FilterProcessedCreditsListForm(GARequestErrorReportingMixin, forms.Form):
                 filters[api_name] = filters[field_name]
                 del filters[field_name]
 
+        # pages are requested by offset or cursor so that filters are the same for every page of results
+        filters.pop('page', None)
+        filters.pop('cursor', None)
+        if self.keyset_pagination:
+            return self.get_keyset_page(filters)
+
         page = self.cleaned_data.get('page') or 1
         offset = (page - 1) * self.page_size
-        count, results = self.retrieve_credits(offset, self.page_size, **filters)
+        cached_results = get_cached_results(self.user, self.result_cache_name, filters, page)
+        if cached_results is None:
+            cached_results = self.retrieve_credits(offset, self.page_size, **filters)
+            cache_results(self.user, self.result_cache_name, filters, page, cached_results)
+        count, results = cached_results
         self.pagination = {
             'page': page,
             'count': count,
             'page_count': int(ceil(count / self.page_size)),
         }
+        if page < self.pagination['page_count']:
+            prefetch_results(
+                self.request, self.result_cache_name, filters, page + 1,
+                functools.partial(self.retrieve_credits, page * self.page_size, self.page_size, **filters),
+            )
         return parse_date_fields(results)
 
-    def retrieve_credits(self, offset, limit, **filters):
-        response = self.session.get(
+    @property
+    def keyset_pagination(self):
+        return settings.PROCESSED_CREDITS_KEYSET_PAGINATION
+
+    def get_keyset_page(self, filters):
+        """
+        Loads a page of batches, which the api lists newest first, starting from the cursor's key.
+        The api can only filter batches by date, so a key is a date and the number of that day's batches
+        already shown. This keeps offsets as small as one day's batches however deep the page.
+        The count of batches from the key onwards also gives the page count without needing earlier pages.
+        Cursors only hold their page's number and key so the previous page's key is found with `get_previous_key`
+        """
+        page, key = load_processed_credits_cursor(self.cleaned_data.get('cursor'))
+        start_date, skip = key or (None, 0)
+        page_filters = dict(filters)
+        if start_date:
+            before = start_date + timedelta(days=1)
+            if not filters.get('logged_at__lt') or before < filters['logged_at__lt']:
+                page_filters['logged_at__lt'] = before
+
+        cache_name = '%s-keyset' % self.result_cache_name
+        cached_results = get_cached_results(self.user, cache_name, page_filters, skip)
+        if cached_results is None:
+            cached_results = self.retrieve_credits(skip, self.page_size, **page_filters)
+            cache_results(self.user, cache_name, page_filters, skip, cached_results)
+        count, results = cached_results
+        remaining = max(count - skip, len(results))
+
+        next_cursor = None
+        if results and remaining > len(results):
+            last_date = parse_date(str(results[-1]['logged_at'])[:10])
+            if last_date == start_date:
+                next_skip = skip + len(results)
+            else:
+                next_skip = sum(1 for batch in results if str(batch['logged_at'])[:10] == last_date.isoformat())
+            next_cursor = dump_processed_credits_cursor(page + 1, (last_date, next_skip))
+        if page > 2:
+            previous_key = self.get_previous_key(filters, start_date, skip)
+            previous_cursor = dump_processed_credits_cursor(page - 1, previous_key) if previous_key else ''
+        else:
+            # the first page has no cursor
+            previous_cursor = '' if key else None
+
+        self.pagination = {
+            'page': page,
+            'count': (page - 1) * self.page_size + remaining,
+            'page_count': page - 1 + int(ceil(remaining / self.page_size)),
+            'previous_cursor': previous_cursor,
+            'next_cursor': next_cursor,
+        }
+        return parse_date_fields(results)
+
+    def get_previous_key(self, filters, start_date, skip):
+        """
+        Finds the key of the page before the one starting at (start_date, skip) with a reverse keyset query
+        or returns None if that is the first page. The previous page ends with the oldest batches
+        of the days after start_date, but as the api only lists batches newest first,
+        they are found by counting batches in windows of days after start_date, doubling in length each time
+        """
+        if skip >= self.page_size:
+            return start_date, skip - self.page_size
+        needed = self.page_size - skip
+        cache_name = '%s-keyset-previous' % self.result_cache_name
+        cache_filters = dict(filters, key='%s-%s' % (start_date.isoformat(), skip))
+        previous_key = get_cached_results(self.user, cache_name, cache_filters, 1)
+        if previous_key is not None:
+            return previous_key or None
+
+        window_start = start_date + timedelta(days=1)
+        latest_end = filters.get('logged_at__lt') or timezone.localdate() + timedelta(days=1)
+        days = 1
+        while True:
+            window_end = min(window_start + timedelta(days=days), latest_end)
+            window_filters = dict(filters, logged_at__gte=window_start, logged_at__lt=window_end)
+            count, results = self.retrieve_credits(0, self.page_size, **window_filters)
+            if count >= needed or window_end >= latest_end:
+                break
+            days *= 2
+
+        if count < needed:
+            previous_key = ()
+        elif count <= len(results):
+            # the window's batches all fit on one page
+            previous_date = str(results[count - needed]['logged_at'])[:10]
+            previous_skip = sum(
+                1 for batch in results[:count - needed] if str(batch['logged_at'])[:10] == previous_date
+            )
+            previous_key = parse_date(previous_date), previous_skip
+        else:
+            offset = count - needed
+            _count, results = self.retrieve_credits(offset, 1, **window_filters)
+            previous_date = parse_date(str(results[0]['logged_at'])[:10])
+            # batches of later days in the window come before those of the previous page's date
+            later_count, _results = self.retrieve_credits(
+                0, 1, **dict(window_filters, logged_at__gte=previous_date + timedelta(days=1))
+            )
+            previous_key = previous_date, offset - later_count
+        cache_results(self.user, cache_name, cache_filters, 1, previous_key)
+        return previous_key or None
+
+    @property
+    def result_cache_name(self):
+        return 'processed-credits'
+
+    def retrieve_credits(self, offset, limit, session=None, **filters):
+        response = (session or self.session).get(
             'credits/processed/',
-            params=dict(offset=offset, limit=self.page_size, **filters)
+            params=dict(offset=offset, limit=limit, **filters)
         ).json()
         return response.get('count', 0), response.get('results', [])
 
     def get_query_data(self):
         data = collections.OrderedDict()
         for field in self:
-            if field.name == 'page':
+            if field.name in ('page', 'cursor'):
                 continue
             value = self.cleaned_data.get(field.name)
             if value in [None, '', []]:
@@ -241,6 +585,10 @@ class FilterProcessedCreditsDetailForm(FilterProcessedCreditsListForm):
         ('end', 'received_at__lt'),
         ('names', 'search'),
     )
+    narrowing_fields = ('start', 'end', 'names', 'prisoner_number')
+
+    page_size = 100
+    keyset_pagination = False
 
     def __init__(self, request, date, user_id, *args, **kwargs):
         super().__init__(request, *args, **kwargs)
@@ -255,11 +603,44 @@ class FilterProcessedCreditsDetailForm(FilterProcessedCreditsListForm):
     def clean_ordering(self):
         return self.cleaned_data['ordering'] or self.fields['ordering'].initial
 
-    def retrieve_credits(self, offset, limit, **filters):
-        credits = retrieve_all_pages_for_path(
-            self.session, 'credits/', **dict(self.default_filters, **filters)
-        )
-        return len(credits), credits
+    @property
+    def result_cache_name(self):
+        return 'processed-credits-%s-%s' % (self.batch_date.strftime('%Y%m%d'), self.default_filters['user'])
+
+    def retrieve_credits(self, offset, limit, session=None, **filters):
+        response = (session or self.session).get(
+            'credits/',
+            params=dict(offset=offset, limit=limit, **dict(self.default_filters, **filters))
+        ).json()
+        return response.get('count', 0), response.get('results', [])
+
+    @cached_property
+    def batch_total(self):
+        """
+        Total amount of the filtered credits or None if it cannot be known without loading every page
+        """
+        credits = self.credit_choices
+        if self.pagination['page_count'] <= 1:
+            return sum(credit['amount'] for credit in credits)
+        if any(self.cleaned_data.get(field) for field in self.narrowing_fields):
+            return None
+        # the api's processed credits list groups credits by the day and user of their `credited` log
+        # and totals their amounts, which are the same credits selected by `default_filters`,
+        # so filtering it by this batch's day and user leaves only this batch's row
+        batch_filters = {
+            'logged_at__gte': self.batch_date,
+            'logged_at__lt': self.batch_date + timedelta(days=1),
+            'user': self.default_filters['user'],
+        }
+        batches = get_cached_results(self.user, 'processed-credit-total', batch_filters, 1)
+        if batches is None:
+            batches = self.session.get('credits/processed/', params=dict(batch_filters, limit=1)).json()
+            batches = batches.get('results', [])
+            cache_results(self.user, 'processed-credit-total', batch_filters, 1, batches)
+        for batch in batches:
+            if str(batch['owner']) == str(self.default_filters['user']):
+                return batch['total']
+        return None
 
 
 class SearchForm(GARequestErrorReportingMixin, forms.Form):
@@ -346,26 +727,45 @@ class SearchForm(GARequestErrorReportingMixin, forms.Form):
                 del filters[field_name]
 
         page = self.cleaned_data.get('page') or 1
+        cached_results = get_cached_results(self.user, 'search', filters, page)
+        if cached_results is None:
+            cached_results = self.retrieve_credits(page, filters)
+            cache_results(self.user, 'search', filters, page, cached_results)
+        self.pagination, results = cached_results
+        return list(map(Credit, results))
+
+    def retrieve_credits(self, page, filters):
         offset = (page - 1) * self.page_size
-        response = self.session.get(
-            'credits/',
-            params=dict(offset=offset, limit=self.page_size, resolution='credited', **filters)
-        ).json()
+        credited_params = dict(offset=offset, limit=self.page_size, resolution='credited', **filters)
+        new_credits_response = None
+        if page == 1:
+            # new credits are only shown on the first page, up to SEARCH_NEW_CREDITS_LIMIT,
+            # and are requested at the same time as credited ones using a copy of the api session
+            # once any expired token has been refreshed in the request's thread
+            refresh_api_token(self.session)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                new_credits_future = executor.submit(
+                    copy_api_session(self.session).get, 'credits/',
+                    params=dict(offset=0, limit=settings.SEARCH_NEW_CREDITS_LIMIT, status='credit_pending', **filters)
+                )
+                response = self.session.get('credits/', params=credited_params).json()
+                new_credits_response = new_credits_future.result().json()
+        else:
+            response = self.session.get('credits/', params=credited_params).json()
         count = response.get('count', 0)
-        self.pagination = {
+        pagination = {
             'page': page,
             'count': count,
             'full_count': count,
             'page_count': int(ceil(count / self.page_size)),
+            'new_count': 0,
         }
         results = response.get('results', [])
-        if page == 1:
-            new_credits = retrieve_all_pages_for_path(
-                self.session, 'credits/', status='credit_pending', **filters
-            )
-            self.pagination['full_count'] += len(new_credits)
-            results = new_credits + results
-        return parse_date_fields(results)
+        if new_credits_response:
+            pagination['new_count'] = new_credits_response.get('count', 0)
+            pagination['full_count'] += pagination['new_count']
+            results = new_credits_response.get('results', []) + results
+        return pagination, results
 
     def _get_filter_description(self):
         if self.cleaned_data:
@@ -0,0 +1,81 @@
+import datetime
+import timeit
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from mtp_cashbook.utils import DateFieldParser, parse_date_value
+
+FIELDS = ('received_at', 'credited_at', 'refunded_at', 'logged_at', 'set_manual_at', 'created')
+
+
+def previous_parse_date_value(value):
+    # the per-value approach previously used for credits and disbursements
+    for parser in (parse_datetime, parse_date):
+        try:
+            parsed_value = parser(value)
+            if not parsed_value:
+                continue
+            if isinstance(parsed_value, datetime.datetime):
+                parsed_value = timezone.localtime(parsed_value)
+            return parsed_value
+        except (ValueError, TypeError):
+            pass
+    return value
+
+
+def previous_parse_date_fields(records):
+    for record in records:
+        for field in FIELDS:
+            value = record.get(field)
+            if value:
+                record[field] = previous_parse_date_value(value)
+    return records
+
+
+def make_records(count):
+    return [
+        {
+            'id': record_id,
+            'received_at': '2017-01-%02dT12:%02d:00.%06dZ' % (record_id % 28 + 1, record_id % 60, record_id),
+            'credited_at': '2017-02-01T09:30:00+00:00',
+            'logged_at': '2017-02-01',
+            'set_manual_at': None,
+        }
+        for record_id in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Times parsing of api date fields against the previous per-value parsing;
+    results depend on the machine so nothing is asserted
+    """
+    help = __doc__.strip()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=2000, help='Number of records to parse in each run')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs; the fastest is reported')
+
+    def handle(self, *args, **options):
+        records, repeat = options['records'], options['repeat']
+        values = [
+            value
+            for record in make_records(records)
+            for value in record.values()
+            if isinstance(value, str)
+        ]
+        parser = DateFieldParser(FIELDS)
+
+        self.report('previous per-value parsing', repeat, lambda: [previous_parse_date_value(v) for v in values])
+        self.report('parse_date_value', repeat, lambda: [
+            timezone.localtime(parsed_value) if isinstance(parsed_value, datetime.datetime) else parsed_value
+            for parsed_value in map(parse_date_value, values)
+        ])
+        self.report('previous parse_date_fields', repeat, lambda: previous_parse_date_fields(make_records(records)))
+        self.report('DateFieldParser', repeat, lambda: parser.parse(make_records(records)))
+
+    def report(self, name, repeat, func):
+        duration = min(timeit.repeat(func, number=1, repeat=repeat))
+        self.stdout.write('%-28s %8.2fms' % (name, duration * 1000))
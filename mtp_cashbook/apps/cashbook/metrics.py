@@ -1,7 +1,19 @@
 from django.apps import apps
-from prometheus_client import Summary
+from prometheus_client import Gauge, Summary
 
 credited_summary = Summary('mtp_cashbook_credited', 'Credits credited')
+credited_confirmation_queue_gauge = Gauge(
+    'mtp_cashbook_credited_confirmation_queue_depth', 'Credited confirmation emails waiting to be sent',
+)
+credited_confirmation_send_summary = Summary(
+    'mtp_cashbook_credited_confirmation_send_seconds', 'Time taken to send a batch of credited confirmation emails',
+)
+credit_batch_size_summary = Summary(
+    'mtp_cashbook_credit_batch_bytes', 'Size of compressed credits passed to a crediting job',
+)
 
 app = apps.get_app_config('metrics')
 app.register_collector(credited_summary)
+app.register_collector(credited_confirmation_queue_gauge)
+app.register_collector(credited_confirmation_send_summary)
+app.register_collector(credit_batch_size_summary)
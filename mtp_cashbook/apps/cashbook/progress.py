@@ -0,0 +1,88 @@
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class CreditingProgress:
+    """
+    Counts the outcomes of crediting a user's batch of credits so that progress can be checked without querying the api.
+    Counts are kept in the `progress` cache, which all web and spooler processes can see, but as that may be
+    a file-based cache without atomic increments, each crediting job only writes its own counts
+    and the counts of all of a batch's jobs are added up when read
+    """
+    outcomes = ('credited', 'manual', 'failed')
+
+    def __init__(self, user_id, job_id=None):
+        self.user_id = user_id
+        self.job_id = job_id or uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.outcomes, 0)
+
+    @property
+    def cache(self):
+        return caches['progress']
+
+    def get_cache_key(self, name):
+        return 'crediting-progress-%s-%s' % (self.user_id, name)
+
+    def get_job_cache_key(self, job_id):
+        return self.get_cache_key('job-%s' % job_id)
+
+    def start(self, total, other_job_ids=()):
+        """
+        Starts progress of a batch that is counted by this and `other_job_ids` jobs
+        """
+        self.cache.set_many({
+            self.get_cache_key('jobs'): [self.job_id] + list(other_job_ids),
+            self.get_cache_key('total'): total,
+        }, timeout=settings.CREDITING_PROGRESS_TTL)
+
+    def add(self, outcome, count=1):
+        if not count:
+            return
+        with self.lock:
+            self.counts[outcome] += count
+            self.cache.set(
+                self.get_job_cache_key(self.job_id), dict(self.counts),
+                timeout=settings.CREDITING_PROGRESS_TTL,
+            )
+
+    def get(self):
+        """
+        Returns counts of credited, manual and failed credits out of the batch total
+        or None if progress is not known
+        """
+        values = self.cache.get_many([self.get_cache_key('total'), self.get_cache_key('jobs')])
+        total = values.get(self.get_cache_key('total'))
+        if not total:
+            return None
+        progress = dict.fromkeys(self.outcomes, 0)
+        job_cache_keys = [self.get_job_cache_key(job_id) for job_id in values.get(self.get_cache_key('jobs')) or []]
+        for counts in self.cache.get_many(job_cache_keys).values():
+            for name in self.outcomes:
+                progress[name] += counts.get(name, 0)
+        progress['total'] = total
+        return self.describe(progress)
+
+    @classmethod
+    def describe(cls, progress):
+        """
+        Adds how many credits are done, which excludes failed credits as they remain pending in the api
+        """
+        total = progress['total']
+        done = min(total, progress.get('credited', 0) + progress.get('manual', 0))
+        return dict(
+            progress,
+            done=done,
+            percentage=int(done / total * 100) if total else 100,
+            complete=done >= total,
+        )
+
+    def clear(self):
+        job_ids = self.cache.get(self.get_cache_key('jobs')) or []
+        self.cache.delete_many(
+            [self.get_cache_key('total'), self.get_cache_key('jobs')] +
+            [self.get_job_cache_key(job_id) for job_id in job_ids]
+        )
@@ -1,34 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import json
 import logging
-from threading import local
+import queue
+import threading
 from urllib.parse import urljoin
+import uuid
+import zlib
 
+from anymail.message import AnymailMessage
 from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.console import EmailBackend as ConsoleEmailBackend
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template import loader
 from django.utils.translation import gettext as _
 from mtp_common.auth.api_client import get_api_session_with_session
 from mtp_common import nomis
-from mtp_common.spooling import spoolable
-from mtp_common.tasks import send_email
+from mtp_common.spooling import Context, spoolable
+from mtp_common.tasks import default_from_address, is_test_email, prepare_context, send_email
 import requests
 from requests.exceptions import HTTPError, RequestException
 
 from cashbook import metrics
+from cashbook.progress import CreditingProgress
+from mtp_cashbook.nomis_utils import (
+    NomisUnavailable, call_nomis, get_account_balances, get_nomis_session, invalidate_account_balances,
+    invalidate_location,
+)
+from mtp_cashbook.records import Credit
+from mtp_cashbook.result_cache import invalidate_cached_results
+from mtp_cashbook.utils import refresh_api_token
 
 logger = logging.getLogger('mtp')
 
-thread_local = local()
-thread_local.nomis_session = requests.Session()
+# the only credit fields needed to credit to NOMIS and send confirmation emails
+CREDIT_BATCH_FIELDS = (
+    'id', 'prison', 'prisoner_number', 'amount',
+    'sender_name', 'sender_email', 'short_payment_ref', 'received_at', 'intended_recipient',
+)
 
 
-@spoolable(body_params=('user', 'user_session', 'selected_credit_ids', 'credits',))
-def credit_selected_credits_to_nomis(*, user, user_session, selected_credit_ids, credits):
-    credited = 0
+def pack_credit_batch(credits):
+    """
+    Serialises credits for a crediting job as compressed rows of CREDIT_BATCH_FIELDS
+    so that spool files stay small
+    """
+    rows = [
+        [credit.get(field) for field in CREDIT_BATCH_FIELDS]
+        for credit in credits
+    ]
+    credit_batch = zlib.compress(json.dumps(rows, separators=(',', ':'), cls=DjangoJSONEncoder).encode())
+    metrics.credit_batch_size_summary.observe(len(credit_batch))
+    return credit_batch
+
+
+def unpack_credit_batch(credit_batch):
+    return {
+        row[0]: Credit(zip(CREDIT_BATCH_FIELDS, row))
+        for row in json.loads(zlib.decompress(credit_batch).decode())
+    }
+
+
+class CreditUpdates:
+    """
+    Collects the outcomes of crediting to NOMIS from several threads and reports them to the api in chunks,
+    once CREDIT_UPDATES_CHUNK_SIZE are waiting or from a timer every CREDIT_UPDATES_INTERVAL seconds;
+    progress is counted once the api has been updated. Chunks that the api does not accept are kept
+    to be reported again and `close` raises if they still cannot be reported
+    """
+
+    def __init__(self, api_session, confirmations, progress):
+        self.api_session = api_session
+        self.confirmations = confirmations
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.credited = []
+        self.manual = []
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.run_timer, name='credit-updates', daemon=True)
+        self.timer.start()
+
+    def add_credited(self, credit_id, credit, nomis_transaction_id=None):
+        credit_update = {'id': credit_id, 'credited': True}
+        if nomis_transaction_id:
+            credit_update['nomis_transaction_id'] = nomis_transaction_id
+        self.add(credited=(credit_update, credit))
+
+    def add_manual(self, credit_id):
+        self.add(manual=int(credit_id))
+
+    def add_failed(self, _credit_id):
+        # failed credits remain pending in the api
+        self.progress.add('failed')
+
+    def add(self, credited=None, manual=None):
+        with self.lock:
+            if credited is not None:
+                self.credited.append(credited)
+            if manual is not None:
+                self.manual.append(manual)
+            flush_due = len(self.credited) + len(self.manual) >= settings.CREDIT_UPDATES_CHUNK_SIZE
+        if flush_due:
+            self.flush()
+
+    def run_timer(self):
+        while not self.closed.wait(settings.CREDIT_UPDATES_INTERVAL):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Credit updates could not be reported')
+
+    def close(self):
+        """
+        Stops the timer and reports all remaining outcomes, raising RequestException if the api does not accept them
+        """
+        self.closed.set()
+        self.timer.join()
+        self.flush(final=True)
+
+    def flush(self, final=False):
+        # only one thread uses the api session at a time
+        with self.flush_lock:
+            with self.lock:
+                credited, self.credited = self.credited, []
+                manual, self.manual = self.manual, []
+
+            if manual:
+                try:
+                    self.api_session.post('credits/actions/setmanual/', json={'credit_ids': manual})
+                except RequestException:
+                    if final:
+                        self.progress.add('failed', len(manual) + len(credited))
+                        raise
+                    logger.warning('Credits %s could not be marked as needing manual input yet' % manual)
+                    self.requeue(credited, manual)
+                    return
+                self.progress.add('manual', len(manual))
+
+            if credited:
+                try:
+                    self.api_session.post('credits/actions/credit/', json=[
+                        credit_update
+                        for credit_update, credit in credited
+                    ])
+                except RequestException:
+                    if final:
+                        self.progress.add('failed', len(credited))
+                        raise
+                    logger.warning('Credits %s could not be marked as credited yet' % [
+                        credit_update['id']
+                        for credit_update, credit in credited
+                    ])
+                    self.requeue(credited, [])
+                    return
+                self.progress.add('credited', len(credited))
+                for _credit_update, credit in credited:
+                    if credit.get('sender_email'):
+                        self.confirmations.add(credit)
+
+    def requeue(self, credited, manual):
+        with self.lock:
+            self.credited = credited + self.credited
+            self.manual = manual + self.manual
+
+
+class CreditedConfirmations:
+    """
+    Queue stage that sends credited confirmation emails from its own thread so that crediting never waits for them;
+    queued credits are taken in batches of up to CREDITED_CONFIRMATION_BATCH_SIZE and each batch is sent
+    with `send_credited_confirmations`
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='credited-confirmations', daemon=True)
+        self.thread.start()
+
+    def add(self, credit):
+        metrics.credited_confirmation_queue_gauge.inc()
+        self.queue.put(credit)
+
+    def close(self):
+        # waits for queued emails to be passed on
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        closed = False
+        while not closed:
+            credits = [self.queue.get()]
+            while len(credits) < settings.CREDITED_CONFIRMATION_BATCH_SIZE:
+                try:
+                    credits.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in credits:
+                closed = True
+                credits.remove(None)
+            if credits:
+                metrics.credited_confirmation_queue_gauge.dec(len(credits))
+                with metrics.credited_confirmation_send_summary.time():
+                    send_credited_confirmations(credits)
+
+
+@spoolable(body_params=('user', 'user_session', 'selected_credit_ids', 'credit_batch', 'credits',))
+def credit_selected_credits_to_nomis(*, user, user_session, selected_credit_ids, credit_batch=None, credits=None,
+                                     spoolable_ctx: Context = None):
+    """
+    Credits selected credits to NOMIS; `credit_batch` is made with `pack_credit_batch`.
+    `credits`, a dict of credits by id, is still accepted for jobs spooled before batches were packed.
+    When spooled, batches larger than CREDITING_JOB_SIZE are split into several jobs
+    so that all spooler processes can work on them
+    """
+    if credit_batch is None:
+        credit_batch = pack_credit_batch((credits or {}).values())
+    credits = unpack_credit_batch(credit_batch)
+    # an expired token is refreshed here so that crediting threads and jobs do not each try to refresh it
+    refresh_api_token(get_api_session_with_session(user, user_session))
+    available_credit_ids = []
     for credit_id in selected_credit_ids:
         if credit_id in credits:
-            credit_individual_credit_to_nomis(user, user_session, credit_id, credits[credit_id])
-            credited += 1
+            available_credit_ids.append(credit_id)
         else:
             logger.warning('Credit %s is no longer available' % credit_id)
-    metrics.credited_summary.observe(credited)
+
+    job_size = settings.CREDITING_JOB_SIZE
+    if spoolable_ctx.spooled and 0 < job_size < len(available_credit_ids):
+        jobs = [
+            (uuid.uuid4().hex, credit_ids)
+            for credit_ids in shard_credit_ids(credits, available_credit_ids, job_size)
+        ]
+    else:
+        jobs = []
+    # each job counts its own part of this batch's progress
+    progress = CreditingProgress(user.pk)
+    progress.start(len(selected_credit_ids), [job_id for job_id, _credit_ids in jobs])
+    progress.add('failed', len(selected_credit_ids) - len(available_credit_ids))
+
+    if jobs:
+        for job_id, credit_ids in jobs:
+            credit_credit_batch_to_nomis(
+                user=user, user_session=user_session,
+                credit_batch=pack_credit_batch(credits[credit_id] for credit_id in credit_ids),
+                progress_job_id=job_id,
+            )
+        return
+
+    credit_credits_to_nomis(user, user_session, credits, available_credit_ids, progress)
+
+
+@spoolable(body_params=('user', 'user_session', 'credit_batch',))
+def credit_credit_batch_to_nomis(*, user, user_session, credit_batch, progress_job_id=None):
+    """
+    Credits one part of a batch split up by `credit_selected_credits_to_nomis`
+    """
+    credits = unpack_credit_batch(credit_batch)
+    progress = CreditingProgress(user.pk, progress_job_id)
+    credit_credits_to_nomis(user, user_session, credits, list(credits), progress)
+
+
+def shard_credit_ids(credits, credit_ids, job_size):
+    """
+    Splits credit ids into lists of up to `job_size` ordered by prison
+    so that each prison's credits are spread over as few jobs as possible
+    """
+    credit_ids = sorted(credit_ids, key=lambda credit_id: (credits[credit_id]['prison'] or '', credit_id))
+    return [
+        credit_ids[offset:offset + job_size]
+        for offset in range(0, len(credit_ids), job_size)
+    ]
+
+
+def credit_credits_to_nomis(user, user_session, credits, credit_ids, progress):
+    confirmations = CreditedConfirmations()
+    credit_updates = CreditUpdates(get_api_session_with_session(user, user_session), confirmations, progress)
+    try:
+        # credits are processed in this task by up to CREDITING_WORKERS threads rather than each being spooled
+        with ThreadPoolExecutor(max_workers=max(1, settings.CREDITING_WORKERS)) as executor:
+            futures = [
+                executor.submit(credit_credit_to_nomis, credit_updates, credit_id, credits[credit_id])
+                for credit_id in credit_ids
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                # an unexpected error stops the rest of the batch, which remains pending
+                cancelled = sum(future.cancel() for future in futures)
+                progress.add('failed', cancelled + 1)
+                raise
+    finally:
+        try:
+            credit_updates.close()
+        finally:
+            confirmations.close()
+            # the user's cached search results are out of date once the api has been updated
+            invalidate_cached_results(user)
+    metrics.credited_summary.observe(len(credit_ids))
 
     if settings.PRISONER_CAPPING_ENABLED:
         prisoner_locations = set(
@@ -41,13 +311,24 @@ def credit_selected_credits_to_nomis(*, user, user_session, selected_credit_ids,
 
 @spoolable()
 def credit_individual_credit_to_nomis(user, user_session, credit_id, credit):
-    api_session = get_api_session_with_session(user, user_session)
-    if not hasattr(thread_local, 'nomis_session'):
-        thread_local.nomis_session = requests.Session()
+    confirmations = CreditedConfirmations()
+    credit_updates = CreditUpdates(
+        get_api_session_with_session(user, user_session), confirmations, CreditingProgress(user.pk),
+    )
+    try:
+        credit_credit_to_nomis(credit_updates, credit_id, credit)
+    finally:
+        try:
+            credit_updates.close()
+        finally:
+            confirmations.close()
+
 
+def credit_credit_to_nomis(credit_updates, credit_id, credit):
     nomis_response = None
     try:
-        nomis_response = nomis.create_transaction(
+        nomis_response = call_nomis(
+            nomis.create_transaction,
             prison_id=credit['prison'],
             prisoner_number=credit['prisoner_number'],
             amount=credit['amount'],
@@ -55,46 +336,112 @@ def credit_individual_credit_to_nomis(user, user_session, credit_id, credit):
             description='Sent by {sender}'.format(sender=credit['sender_name']),
             transaction_type='MTDS',
             retries=1,
-            session=thread_local.nomis_session
+            session=get_nomis_session(),
         )
     except HTTPError as e:
         if e.response.status_code == 409:
             logger.warning('Credit %s was already present in NOMIS' % credit_id)
         elif e.response.status_code >= 500:
             logger.error('Credit %s could not credited as NOMIS is unavailable' % credit_id)
+            credit_updates.add_failed(credit_id)
             return
         else:
             logger.warning('Credit %s cannot be automatically credited to NOMIS' % credit_id)
-            api_session.post(
-                'credits/actions/setmanual/',
-                json={'credit_ids': [int(credit_id)]}
-            )
+            # the prisoner has likely moved so their location will need to be looked up again
+            invalidate_location(credit['prisoner_number'])
+            credit_updates.add_manual(credit_id)
             return
+    except NomisUnavailable:
+        # NOMIS has been failing recently so the credit is not attempted and remains pending
+        logger.warning('Credit %s was not credited as NOMIS is unavailable' % credit_id)
+        credit_updates.add_failed(credit_id)
+        return
     except RequestException:
         logger.exception('Credit %s could not credited as NOMIS is unavailable' % credit_id)
+        credit_updates.add_failed(credit_id)
         return
+    finally:
+        invalidate_account_balances(credit['prison'], credit['prisoner_number'])
 
-    credit_update = {'id': credit_id, 'credited': True}
+    nomis_transaction_id = None
     if nomis_response and 'id' in nomis_response:
-        credit_update['nomis_transaction_id'] = nomis_response['id']
-    api_session.post('credits/actions/credit/', json=[credit_update])
-
-    if credit.get('sender_email'):
-        send_email(
-            credit['sender_email'], 'cashbook/email/credited-confirmation.txt',
-            _('Send money to someone in prison: the prisoner’s account has been credited'),
-            context={
-                'amount': credit['amount'],
-                'ref_number': credit.get('short_payment_ref'),
-                'received_at': credit['received_at'],
-                'prisoner_name': credit.get('intended_recipient'),
-                'help_url': urljoin(settings.SEND_MONEY_URL, '/help/'),
-                'feedback_url': urljoin(settings.SEND_MONEY_URL, '/contact-us/'),
-                'site_url': settings.START_PAGE_URL,
-            },
-            html_template='cashbook/email/credited-confirmation.html',
-            anymail_tags=['credited'],
-        )
+        nomis_transaction_id = nomis_response['id']
+    credit_updates.add_credited(credit_id, credit, nomis_transaction_id)
+
+
+def get_credited_confirmation_kwargs(credit):
+    return dict(
+        to=credit['sender_email'],
+        text_template='cashbook/email/credited-confirmation.txt',
+        subject=_('Send money to someone in prison: the prisoner’s account has been credited'),
+        context={
+            'amount': credit['amount'],
+            'ref_number': credit.get('short_payment_ref'),
+            'received_at': credit['received_at'],
+            'prisoner_name': credit.get('intended_recipient'),
+            'help_url': urljoin(settings.SEND_MONEY_URL, '/help/'),
+            'feedback_url': urljoin(settings.SEND_MONEY_URL, '/contact-us/'),
+            'site_url': settings.START_PAGE_URL,
+        },
+        html_template='cashbook/email/credited-confirmation.html',
+        anymail_tags=['credited'],
+    )
+
+
+@functools.lru_cache()
+def get_template(template_name):
+    # credited confirmation templates are compiled once per process
+    return loader.get_template(template_name)
+
+
+def prepare_credited_confirmation(credit):
+    """
+    Builds a credited confirmation email like `mtp_common.tasks.send_email` would
+    """
+    kwargs = get_credited_confirmation_kwargs(credit)
+    context = prepare_context(kwargs['context'])
+    email = AnymailMessage(
+        subject=kwargs['subject'],
+        body=get_template(kwargs['text_template']).render(context).strip('\n'),
+        from_email=default_from_address(),
+        to=[kwargs['to']],
+    )
+    email.tags = kwargs['anymail_tags']
+    email.attach_alternative(get_template(kwargs['html_template']).render(context), 'text/html')
+    return email
+
+
+def send_credited_confirmations(credits):
+    """
+    Sends a batch of credited confirmation emails through one connection to the email backend;
+    emails that the backend does not accept are passed to `mtp_common.tasks.send_email`, which is spooled
+    so that they are retried
+    """
+    emails = []
+    for credit in credits:
+        # one email failing, for whatever reason, must not prevent the rest
+        try:
+            emails.append((credit, prepare_credited_confirmation(credit)))
+        except Exception:
+            logger.exception('Credited confirmation email could not be sent for credit %s' % credit.get('id'))
+    if not emails:
+        return
+
+    with get_connection() as connection:
+        for credit, email in emails:
+            if settings.ENVIRONMENT != 'prod' and all(is_test_email(recipient) for recipient in email.recipients()):
+                ConsoleEmailBackend(fail_silently=False).write_message(email)
+                continue
+            try:
+                connection.send_messages([email])
+            except Exception:
+                logger.warning('Credited confirmation email for credit %s will be retried' % credit.get('id'))
+                try:
+                    send_email(**get_credited_confirmation_kwargs(credit))
+                except Exception:
+                    logger.exception(
+                        'Credited confirmation email could not be sent for credit %s' % credit.get('id')
+                    )
 
 
 NOMIS_ACCOUNTS = {'cash', 'spends', 'savings'}
@@ -104,7 +451,7 @@ NOMIS_ACCOUNTS = {'cash', 'spends', 'savings'}
 def check_balance_is_below_cap(prison, prisoner_number):
     # NB: balances are not known in private estate currently, but cashbook is not used in there
     try:
-        nomis_account_balances = nomis.get_account_balances(prison, prisoner_number)
+        nomis_account_balances = get_account_balances(prison, prisoner_number)
         assert set(nomis_account_balances.keys()) == NOMIS_ACCOUNTS, 'response keys differ from expected'
         assert all(
             isinstance(nomis_account_balances[account], int) and nomis_account_balances[account] >= 0
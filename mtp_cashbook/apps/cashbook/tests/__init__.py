@@ -2,6 +2,7 @@ from unittest import mock
 from urllib.parse import urljoin
 
 from django.conf import settings
+from django.core.cache import caches
 from django.test import SimpleTestCase
 from django.urls import reverse
 from django.utils.functional import cached_property
@@ -13,6 +14,8 @@ from mtp_cashbook import READ_ML_BRIEFING_FLAG
 class MTPBaseTestCase(SimpleTestCase):
     def setUp(self):
         super().setUp()
+        for each_cache in caches.all():
+            each_cache.clear()
         self.notifications_mock = mock.patch('mtp_common.templatetags.mtp_common.notifications_for_request',
                                              return_value=[])
         self.notifications_mock.start()
@@ -0,0 +1,448 @@
+import json
+import threading
+import time
+from unittest import mock
+
+from anymail.exceptions import AnymailRequestsAPIError
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail import get_connection
+from django.test import SimpleTestCase, override_settings
+from mtp_common.auth.test_utils import generate_tokens
+from mtp_common.spooling import Context
+from mtp_common.tasks import send_email
+from mtp_common.test_utils import silence_logger
+from requests.exceptions import HTTPError, RequestException
+import responses
+
+from cashbook import metrics
+from cashbook.progress import CreditingProgress
+from cashbook.tasks import (
+    CreditUpdates, CreditedConfirmations, credit_credit_batch_to_nomis, credit_selected_credits_to_nomis,
+    pack_credit_batch, send_credited_confirmations, unpack_credit_batch,
+    prepare_credited_confirmation as real_prepare_credited_confirmation,
+)
+from cashbook.tests import api_url
+from mtp_cashbook.nomis_utils import nomis_circuit_breaker
+from mtp_cashbook.result_cache import cache_results, get_cached_results
+
+
+def make_credit(credit_id, prisoner_number):
+    return {
+        'id': credit_id,
+        'prisoner_name': 'John Smith',
+        'prisoner_number': prisoner_number,
+        'prison': 'BXI',
+        'amount': 1000 + credit_id,
+        'sender_name': 'Fred Smith',
+        'sender_email': None,
+        'short_payment_ref': 'REF%s' % credit_id,
+        'received_at': '2017-01-25T12:00:00Z',
+    }
+
+
+@override_settings(PRISONER_CAPPING_ENABLED=False)
+class CreditSelectedCreditsTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for each_cache in caches.all():
+            each_cache.clear()
+        self.user = mock.Mock(pk=1, token=generate_tokens())
+
+    def credit(self, credits):
+        credit_selected_credits_to_nomis(
+            user=self.user, user_session={},
+            selected_credit_ids=[credit['id'] for credit in credits],
+            credit_batch=pack_credit_batch(credits),
+        )
+
+    @override_settings(CREDITING_WORKERS=3)
+    @mock.patch('cashbook.tasks.nomis.create_transaction')
+    def test_credits_are_processed_concurrently(self, mock_create_transaction):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def create_transaction(**kwargs):
+            # fails with BrokenBarrierError unless 3 credits are being processed at once
+            barrier.wait()
+            return {'id': '%s-1' % kwargs['record_id']}
+
+        mock_create_transaction.side_effect = create_transaction
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 4)]
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+            credited = json.loads(rsps.calls[0].request.body.decode())
+        self.assertEqual(mock_create_transaction.call_count, 3)
+        self.assertCountEqual(credited, [
+            {'id': credit_id, 'credited': True, 'nomis_transaction_id': '%s-1' % credit_id}
+            for credit_id in range(1, 4)
+        ])
+
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_jobs_spooled_with_credits_are_still_credited(self, _):
+        # jobs spooled before credit batches were packed pass a dict of credits by id
+        credits = {credit_id: make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 3)}
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            credit_selected_credits_to_nomis(
+                user=self.user, user_session={},
+                selected_credit_ids=[1, 2, 3],
+                credits=credits,
+            )
+            credited = json.loads(rsps.calls[0].request.body.decode())
+        self.assertCountEqual([credit_update['id'] for credit_update in credited], [1, 2])
+        self.assertDictEqual(CreditingProgress(self.user.pk).get(), {
+            'total': 3, 'credited': 2, 'manual': 0, 'failed': 1,
+            'done': 2, 'percentage': 66, 'complete': False,
+        })
+
+    @override_settings(CREDITING_WORKERS=4)
+    @mock.patch('cashbook.tasks.nomis.create_transaction')
+    def test_error_handling_is_per_credit(self, mock_create_transaction):
+        status_codes = {'1': None, '2': 409, '3': 500, '4': 400}
+
+        def create_transaction(**kwargs):
+            status_code = status_codes[kwargs['record_id']]
+            if status_code:
+                raise HTTPError(response=mock.Mock(status_code=status_code))
+            return {'id': '%s-1' % kwargs['record_id']}
+
+        mock_create_transaction.side_effect = create_transaction
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 5)]
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.POST, api_url('/credits/actions/setmanual/'), status=204)
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+            self.assertEqual(len(rsps.calls), 2)
+            manual = json.loads(rsps.calls[0].request.body.decode())
+            credited = json.loads(rsps.calls[1].request.body.decode())
+        self.assertDictEqual(manual, {'credit_ids': [4]})
+        self.assertCountEqual(credited, [
+            {'id': 1, 'credited': True, 'nomis_transaction_id': '1-1'},
+            {'id': 2, 'credited': True},
+        ])
+        self.assertDictEqual(CreditingProgress(self.user.pk).get(), {
+            'total': 4, 'credited': 2, 'manual': 1, 'failed': 1,
+            'done': 3, 'percentage': 75, 'complete': False,
+        })
+
+    @override_settings(CREDITING_WORKERS=2, CREDIT_UPDATES_CHUNK_SIZE=2)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_credit_updates_are_chunked(self, _):
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 6)]
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _ in range(5):
+                rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+            chunks = [
+                json.loads(call.request.body.decode())
+                for call in rsps.calls
+            ]
+        self.assertGreaterEqual(len(chunks), 2)
+        self.assertTrue(all(1 <= len(chunk) <= 3 for chunk in chunks))
+        self.assertCountEqual(
+            [credit_update['id'] for chunk in chunks for credit_update in chunk],
+            range(1, 6),
+        )
+
+    @override_settings(CREDITING_JOB_SIZE=2)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_spooled_batches_are_split_into_jobs(self, _):
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 6)]
+        for credit in credits[::2]:
+            credit['prison'] = 'LEI'
+        with mock.patch('cashbook.tasks.credit_credit_batch_to_nomis') as mock_credit_credit_batch_to_nomis:
+            credit_selected_credits_to_nomis.func(
+                user=self.user, user_session={},
+                selected_credit_ids=[credit['id'] for credit in credits] + [6],
+                credit_batch=pack_credit_batch(credits),
+                spoolable_ctx=Context(spooled=True),
+            )
+        jobs = [call[1] for call in mock_credit_credit_batch_to_nomis.call_args_list]
+        self.assertListEqual(
+            [list(unpack_credit_batch(job['credit_batch'])) for job in jobs],
+            [[2, 4], [1, 3], [5]],
+        )
+
+        with responses.RequestsMock() as rsps:
+            for _ in jobs:
+                rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            for job in jobs:
+                credit_credit_batch_to_nomis(**job)
+        self.assertDictEqual(CreditingProgress(self.user.pk).get(), {
+            'total': 6, 'credited': 5, 'manual': 0, 'failed': 1,
+            'done': 5, 'percentage': 83, 'complete': False,
+        })
+
+    @override_settings(CREDITING_JOB_SIZE=2)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_batches_are_not_split_when_not_spooled(self, _):
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 6)]
+        with responses.RequestsMock() as rsps, \
+                mock.patch('cashbook.tasks.credit_credit_batch_to_nomis') as mock_credit_credit_batch_to_nomis:
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+        mock_credit_credit_batch_to_nomis.assert_not_called()
+        self.assertTrue(CreditingProgress(self.user.pk).get()['complete'])
+
+    @override_settings(RESULT_CACHE_TTL=30)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_cached_results_are_invalidated_once_credited(self, _):
+        cache_results(self.user, 'search', {}, 1, ({'count': 1}, [make_credit(1, 'A1231BC')]))
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit([make_credit(1, 'A1231BC')])
+        self.assertIsNone(get_cached_results(self.user, 'search', {}, 1))
+
+    @override_settings(CREDITING_WORKERS=1, NOMIS_CIRCUIT_MIN_CALLS=2, NOMIS_CIRCUIT_FAILURE_RATE=0.5)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=HTTPError(response=mock.Mock(status_code=503)),
+    )
+    def test_batch_fails_fast_when_nomis_is_unavailable(self, mock_create_transaction):
+        nomis_circuit_breaker.reset()
+        self.addCleanup(nomis_circuit_breaker.reset)
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 6)]
+        with responses.RequestsMock(), silence_logger():
+            self.credit(credits)
+        self.assertEqual(mock_create_transaction.call_count, 2)
+        self.assertEqual(CreditingProgress(self.user.pk).get()['failed'], 5)
+
+    @override_settings(CREDITING_WORKERS=1)
+    @mock.patch('cashbook.tasks.nomis.create_transaction', side_effect=ValueError('Unexpected response'))
+    def test_unexpected_error_stops_batch(self, mock_create_transaction):
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 6)]
+        with responses.RequestsMock(), silence_logger(), self.assertRaises(ValueError):
+            self.credit(credits)
+        self.assertLess(mock_create_transaction.call_count, 5)
+        self.assertEqual(CreditingProgress(self.user.pk).get()['failed'], 5 - mock_create_transaction.call_count + 1)
+
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_expired_token_is_refreshed_once_before_crediting(self, _):
+        self.user.token = generate_tokens(expires_at=time.time() - 60, expires_in=60, token_type='Bearer')
+        new_token = generate_tokens(expires_in=36000, token_type='Bearer')
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 4)]
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/oauth2/token/'), json=new_token)
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+            self.assertEqual(len(rsps.calls), 2)
+            self.assertEqual(
+                rsps.calls[1].request.headers['Authorization'],
+                'Bearer %s' % new_token['access_token'],
+            )
+        self.assertEqual(self.user.token['access_token'], new_token['access_token'])
+
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': '%s-1' % kwargs['record_id']},
+    )
+    def test_token_is_not_refreshed_before_it_expires(self, _):
+        self.user.token = generate_tokens(expires_at=time.time() + 60, expires_in=60, token_type='Bearer')
+        token = self.user.token
+        credits = [make_credit(credit_id, 'A123%sBC' % credit_id) for credit_id in range(1, 4)]
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/credits/actions/credit/'), status=204)
+            self.credit(credits)
+            self.assertEqual(len(rsps.calls), 1)
+        self.assertEqual(self.user.token, token)
+
+
+class CreditUpdatesTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for each_cache in caches.all():
+            each_cache.clear()
+        self.api_session = mock.Mock()
+        self.confirmations = mock.Mock()
+        self.progress = CreditingProgress(1)
+        self.progress.start(2)
+
+    @override_settings(CREDIT_UPDATES_INTERVAL=0.01, CREDIT_UPDATES_CHUNK_SIZE=10)
+    def test_updates_are_flushed_on_a_timer(self):
+        credit_updates = CreditUpdates(self.api_session, self.confirmations, self.progress)
+        credit_updates.add_credited(1, make_credit(1, 'A1231BC'))
+        for _ in range(500):
+            if self.api_session.post.called:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.api_session.post.called)
+        credit_updates.close()
+        self.api_session.post.assert_called_once_with('credits/actions/credit/', json=[{'id': 1, 'credited': True}])
+        self.assertEqual(self.progress.get()['credited'], 1)
+
+    @override_settings(CREDIT_UPDATES_INTERVAL=60, CREDIT_UPDATES_CHUNK_SIZE=1)
+    def test_rejected_chunks_are_reported_again(self):
+        self.api_session.post.side_effect = [RequestException, None, None]
+        credit_updates = CreditUpdates(self.api_session, self.confirmations, self.progress)
+        with silence_logger():
+            credit_updates.add_credited(1, make_credit(1, 'A1231BC'))
+        credit_updates.add_manual(2)
+        credit_updates.close()
+        self.assertEqual(self.api_session.post.call_count, 3)
+        self.api_session.post.assert_called_with('credits/actions/credit/', json=[{'id': 1, 'credited': True}])
+        progress = self.progress.get()
+        self.assertEqual(progress['credited'], 1)
+        self.assertEqual(progress['manual'], 1)
+
+    @override_settings(CREDIT_UPDATES_INTERVAL=60, CREDIT_UPDATES_CHUNK_SIZE=10)
+    def test_unreported_updates_raise_when_closed(self):
+        self.api_session.post.side_effect = RequestException
+        credit_updates = CreditUpdates(self.api_session, self.confirmations, self.progress)
+        credit_updates.add_credited(1, make_credit(1, 'A1231BC'))
+        with self.assertRaises(RequestException):
+            credit_updates.close()
+        self.assertEqual(self.progress.get()['failed'], 1)
+
+
+@override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to .local
+class CreditedConfirmationsTestCase(SimpleTestCase):
+    def make_credit(self, credit_id):
+        credit = make_credit(credit_id, 'A1234BC')
+        credit['sender_email'] = 'sender-%s@mail.local' % credit_id
+        return credit
+
+    @override_settings(CREDITED_CONFIRMATION_BATCH_SIZE=2)
+    @mock.patch('cashbook.tasks.send_credited_confirmations')
+    def test_emails_are_queued_and_sent_in_batches(self, mock_send_credited_confirmations):
+        first_batch_sending = threading.Event()
+        release = threading.Event()
+        batches = []
+
+        def send_credited_confirmations(credits):
+            batches.append([credit['id'] for credit in credits])
+            first_batch_sending.set()
+            release.wait(5)
+
+        mock_send_credited_confirmations.side_effect = send_credited_confirmations
+        confirmations = CreditedConfirmations()
+        confirmations.add(self.make_credit(1))
+        self.assertTrue(first_batch_sending.wait(5))
+        # adding to the queue does not wait for sending
+        for credit_id in range(2, 6):
+            confirmations.add(self.make_credit(credit_id))
+        self.assertEqual(metrics.credited_confirmation_queue_gauge._value.get(), 4)
+        release.set()
+        confirmations.close()
+
+        self.assertListEqual(batches, [[1], [2, 3], [4, 5]])
+        self.assertEqual(metrics.credited_confirmation_queue_gauge._value.get(), 0)
+
+    def test_emails_are_sent(self):
+        confirmations = CreditedConfirmations()
+        for credit_id in range(1, 4):
+            confirmations.add(self.make_credit(credit_id))
+        confirmations.close()
+        self.assertCountEqual(
+            [email.to[0] for email in mail.outbox],
+            ['sender-1@mail.local', 'sender-2@mail.local', 'sender-3@mail.local'],
+        )
+        self.assertIn('REF1', next(email.body for email in mail.outbox if email.to[0] == 'sender-1@mail.local'))
+
+    @override_settings(CREDITED_CONFIRMATION_BATCH_SIZE=3)
+    def test_batches_are_sent_through_one_connection(self):
+        with mock.patch('cashbook.tasks.get_connection', wraps=get_connection) as mock_get_connection:
+            send_credited_confirmations([self.make_credit(credit_id) for credit_id in range(1, 4)])
+        self.assertEqual(mock_get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_failing_email_does_not_prevent_others(self):
+        def prepare_credited_confirmation(credit):
+            if credit['sender_email'] == 'sender-1@mail.local':
+                raise ValueError('Template could not be rendered')
+            return real_prepare_credited_confirmation(credit)
+
+        with mock.patch('cashbook.tasks.prepare_credited_confirmation', side_effect=prepare_credited_confirmation), \
+                silence_logger():
+            confirmations = CreditedConfirmations()
+            for credit_id in range(1, 4):
+                confirmations.add(self.make_credit(credit_id))
+            confirmations.close()
+        self.assertCountEqual(
+            [email.to[0] for email in mail.outbox],
+            ['sender-2@mail.local', 'sender-3@mail.local'],
+        )
+        self.assertEqual(metrics.credited_confirmation_queue_gauge._value.get(), 0)
+
+    def test_rejected_emails_are_passed_on_to_be_retried(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=[RequestException, 1]), \
+                mock.patch('cashbook.tasks.send_email', wraps=send_email) as mock_send_email, \
+                silence_logger():
+            send_credited_confirmations([self.make_credit(1)])
+        mock_send_email.assert_called_once()
+        self.assertEqual(mock_send_email.call_args[1]['to'], 'sender-1@mail.local')
+
+    def test_invalid_address_is_only_a_warning(self):
+        error = AnymailRequestsAPIError('rejected', status_code=400, response=mock.Mock(status_code=400))
+        error.response.json.return_value = {'message': "'to' parameter is not a valid address"}
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=error), \
+                mock.patch('mtp_common.tasks.logger') as mock_logger, \
+                silence_logger():
+            confirmations = CreditedConfirmations()
+            confirmations.add(self.make_credit(1))
+            confirmations.close()
+        mock_logger.warning.assert_called_once_with("'to' parameter is not a valid address")
+
+
+class CreditingProgressTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for each_cache in caches.all():
+            each_cache.clear()
+
+    def test_counts_of_each_job_are_added_up(self):
+        progress = CreditingProgress(1)
+        progress.start(5, ['job-2'])
+        job_progress = CreditingProgress(1, 'job-2')
+        progress.add('credited')
+        job_progress.add('credited', 2)
+        job_progress.add('manual')
+        # jobs that are not part of the batch are not counted
+        CreditingProgress(1, 'job-3').add('credited')
+        self.assertDictEqual(CreditingProgress(1).get(), {
+            'total': 5, 'credited': 3, 'manual': 1, 'failed': 0,
+            'done': 4, 'percentage': 80, 'complete': False,
+        })
+
+    def test_clear(self):
+        progress = CreditingProgress(1)
+        progress.start(1)
+        progress.add('credited')
+        progress.clear()
+        self.assertIsNone(CreditingProgress(1).get())
+        self.assertIsNone(caches['progress'].get(progress.get_job_cache_key(progress.job_id)))
+
+
+class CreditBatchTestCase(SimpleTestCase):
+    def test_only_needed_fields_are_packed(self):
+        credits = [dict(make_credit(credit_id, 'A1234BC'), comments='x' * 1000) for credit_id in range(1, 101)]
+        credit_batch = pack_credit_batch(credits)
+        self.assertLess(len(credit_batch), len(json.dumps(credits)) / 10)
+
+        unpacked = unpack_credit_batch(credit_batch)
+        self.assertListEqual(list(unpacked), list(range(1, 101)))
+        credit = unpacked[1]
+        self.assertEqual(credit['prisoner_number'], 'A1234BC')
+        self.assertEqual(credit['amount'], 1001)
+        self.assertEqual(credit['short_payment_ref'], 'REF1')
+        self.assertEqual(credit['received_at'].year, 2017)
+        self.assertNotIn('comments', credit)
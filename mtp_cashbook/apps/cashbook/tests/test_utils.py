@@ -0,0 +1,481 @@
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pickle
+import threading
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from mtp_common.auth.api_client import get_api_session_with_session
+from mtp_common.auth.test_utils import generate_tokens
+from requests.exceptions import HTTPError, RequestException
+import responses
+
+from cashbook.tests import api_url
+from mtp_cashbook.metrics import (
+    location_cache_hit_counter, nomis_pool_hit_counter, nomis_pool_miss_counter,
+)
+from mtp_cashbook.nomis_utils import (
+    NomisHTTPAdapter, NomisSessionPool, NomisUnavailable,
+    call_nomis, get_account_balances, get_location, invalidate_account_balances, invalidate_location,
+    nomis_circuit_breaker, nomis_concurrency_limiter,
+)
+from mtp_cashbook.records import Credit
+from mtp_cashbook.utils import DateFieldParser, iterate_all_pages, map_concurrently
+
+
+class MapConcurrentlyTestCase(SimpleTestCase):
+    def test_results_keep_order(self):
+        results = map_concurrently(lambda item: item * 2, [3, 1, 2], max_workers=2, timeout=5)
+        self.assertListEqual(results, [6, 2, 4])
+
+    def test_empty_items(self):
+        self.assertListEqual(map_concurrently(lambda item: item, [], max_workers=2, timeout=5), [])
+
+    def test_failing_items_degrade_individually(self):
+        def func(item):
+            if item == 2:
+                raise RequestException
+            return item
+
+        results = map_concurrently(func, [1, 2, 3], max_workers=3, timeout=5, default='failed')
+        self.assertListEqual(results, [1, 'failed', 3])
+
+    def test_unexpected_errors_propagate(self):
+        def func(_):
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            map_concurrently(func, [1], max_workers=1, timeout=5)
+
+    def test_slow_items_miss_deadline(self):
+        release = threading.Event()
+
+        def func(item):
+            if item == 2:
+                release.wait(5)
+            return item
+
+        with self.assertLogs('mtp', level='WARNING'):
+            results = map_concurrently(func, [1, 2, 3], max_workers=3, timeout=0.2)
+        release.set()
+        self.assertListEqual(results, [1, None, 3])
+
+
+@override_settings(REQUEST_PAGE_SIZE=2)
+class IterateAllPagesTestCase(SimpleTestCase):
+    def make_session(self, token=None):
+        user = mock.Mock(token=token or generate_tokens(token_type='Bearer'))
+        return get_api_session_with_session(user, {})
+
+    def add_pages(self, rsps, count, barrier=None):
+        def get(request):
+            params = parse_qs(urlsplit(request.url).query)
+            offset, limit = int(params['offset'][0]), int(params['limit'][0])
+            if barrier and offset:
+                # fails with BrokenBarrierError unless following pages are requested at once
+                barrier.wait()
+            return 200, {}, json.dumps({
+                'count': count,
+                'results': list(range(offset, min(offset + limit, count))),
+            })
+
+        rsps.add_callback(rsps.GET, api_url('/credits/'), callback=get)
+
+    @override_settings(REQUEST_PAGE_PREFETCH=3)
+    def test_pages_are_prefetched_concurrently(self):
+        with responses.RequestsMock() as rsps:
+            self.add_pages(rsps, 7, barrier=threading.Barrier(3, timeout=5))
+            results = list(iterate_all_pages(self.make_session(), 'credits/', resolution='pending'))
+            self.assertListEqual(results, list(range(7)))
+            self.assertEqual(len(rsps.calls), 4)
+            self.assertTrue(any('offset=6' in call.request.url for call in rsps.calls))
+
+    def test_results_are_yielded_before_all_pages_load(self):
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            self.add_pages(rsps, 100)
+            results = iterate_all_pages(self.make_session(), 'credits/')
+            self.assertListEqual([next(results), next(results)], [0, 1])
+            results.close()
+            self.assertLess(len(rsps.calls), 50)
+
+    @override_settings(REQUEST_PAGE_PREFETCH=3)
+    def test_expired_token_is_refreshed_once_before_pages_are_prefetched(self):
+        new_token = generate_tokens(expires_in=36000, token_type='Bearer')
+        session = self.make_session(generate_tokens(expires_at=time.time() - 60, expires_in=60, token_type='Bearer'))
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/oauth2/token/'), json=new_token)
+            self.add_pages(rsps, 7)
+            self.assertListEqual(list(iterate_all_pages(session, 'credits/')), list(range(7)))
+            token_calls = [call for call in rsps.calls if call.request.url.endswith('/oauth2/token/')]
+            self.assertEqual(len(token_calls), 1)
+            for call in rsps.calls[1:]:
+                self.assertEqual(call.request.headers['Authorization'], 'Bearer %s' % new_token['access_token'])
+
+
+class DateFieldParserTestCase(SimpleTestCase):
+    fields = ('received_at', 'credited_at', 'refunded_at', 'logged_at', 'set_manual_at', 'created')
+
+    def make_records(self, count):
+        return [
+            {
+                'id': record_id,
+                'received_at': '2017-01-%02dT12:%02d:00.%06dZ' % (record_id % 28 + 1, record_id % 60, record_id),
+                'credited_at': '2017-02-01T09:30:00+00:00',
+                'logged_at': '2017-02-01',
+                'set_manual_at': None,
+            }
+            for record_id in range(count)
+        ]
+
+    def test_formats(self):
+        record = {
+            'received_at': '2017-06-25T12:00:00Z',
+            'credited_at': '2017-06-25T14:30:15.123456+01:00',
+            'refunded_at': '2017-06-25 12:00',
+            'logged_at': '2017-06-25',
+            'set_manual_at': 'not a date',
+            'created': None,
+        }
+        DateFieldParser(self.fields).parse([record])
+        self.assertEqual(record['received_at'], datetime.datetime(2017, 6, 25, 12, tzinfo=timezone.utc))
+        self.assertEqual(str(record['received_at'].tzinfo), 'Europe/London')
+        self.assertEqual(record['received_at'].hour, 13)
+        self.assertEqual(
+            record['credited_at'],
+            datetime.datetime(2017, 6, 25, 13, 30, 15, 123456, tzinfo=timezone.utc),
+        )
+        self.assertEqual(record['refunded_at'], '2017-06-25 12:00')
+        self.assertEqual(record['logged_at'], datetime.date(2017, 6, 25))
+        self.assertEqual(record['set_manual_at'], 'not a date')
+        self.assertIsNone(record['created'])
+
+    def test_matches_django_parsers(self):
+        def reference_parse(value):
+            return timezone.localtime(parse_datetime(value)) if 'T' in value else parse_date(value)
+
+        records = self.make_records(50)
+        expected = [
+            {field: reference_parse(value) for field, value in record.items() if isinstance(value, str)}
+            for record in records
+        ]
+        parsed = DateFieldParser(self.fields).parse(records)
+        self.assertListEqual([
+            {field: value for field, value in record.items() if field in self.fields and value}
+            for record in parsed
+        ], expected)
+
+    def test_matches_previous_parse_date_fields(self):
+        # the per-value approach previously used for credits and disbursements
+        def reference_parse_date_fields(records):
+            for record in records:
+                for field in self.fields:
+                    value = record.get(field)
+                    if not value:
+                        continue
+                    for parser in (parse_datetime, parse_date):
+                        try:
+                            parsed_value = parser(value)
+                            if not parsed_value:
+                                continue
+                            if isinstance(parsed_value, datetime.datetime):
+                                parsed_value = timezone.localtime(parsed_value)
+                            record[field] = parsed_value
+                            break
+                        except (ValueError, TypeError):
+                            pass
+            return records
+
+        self.assertListEqual(
+            DateFieldParser(self.fields).parse(self.make_records(200)),
+            reference_parse_date_fields(self.make_records(200)),
+        )
+
+
+class RecordTestCase(SimpleTestCase):
+    data = {
+        'id': 1,
+        'amount': 1000,
+        'prisoner_number': 'A1234BC',
+        'received_at': '2017-06-25T12:00:00Z',
+        'set_manual_at': None,
+        'logged_at': '2017-06-26',
+        'source': 'online',
+    }
+
+    def test_dict_and_attribute_access(self):
+        credit = Credit(self.data)
+        self.assertFalse(hasattr(credit, '__dict__'))
+        self.assertEqual(credit.amount, 1000)
+        self.assertEqual(credit['prisoner_number'], 'A1234BC')
+        self.assertEqual(credit['source'], 'online')
+        self.assertIsNone(credit.get('unknown'))
+        with self.assertRaises(KeyError):
+            credit['unknown']
+
+        credit['new_location'] = {'nomis_id': 'BXI'}
+        credit.update(comments='moved')
+        self.assertDictEqual(credit.new_location, {'nomis_id': 'BXI'})
+        self.assertEqual(credit['comments'], 'moved')
+
+    def test_missing_fields_behave_like_dict_keys(self):
+        credit = Credit(self.data)
+        self.assertIn('set_manual_at', credit)
+        self.assertNotIn('sender_email', credit)
+        self.assertEqual(credit.get('sender_email', 'unknown'), 'unknown')
+        with self.assertRaises(KeyError):
+            credit['sender_email']
+        self.assertIsNone(credit.sender_email)
+        self.assertDictEqual(credit.raw_items(), self.data)
+
+        credit['sender_email'] = 'sender@outside.local'
+        self.assertIn('sender_email', credit)
+        self.assertEqual(len(credit), len(self.data) + 1)
+
+    def test_records_are_unhashable(self):
+        with self.assertRaises(TypeError):
+            hash(Credit(self.data))
+
+    def test_dates_are_parsed_when_read(self):
+        credit = Credit(self.data)
+        self.assertEqual(credit.raw_items()['received_at'], '2017-06-25T12:00:00Z')
+        self.assertEqual(credit['received_at'], datetime.datetime(2017, 6, 25, 12, tzinfo=timezone.utc))
+        self.assertEqual(credit.received_at.hour, 13)
+        self.assertEqual(credit['logged_at'], datetime.date(2017, 6, 26))
+        self.assertIsNone(credit.set_manual_at)
+
+    def test_pickling(self):
+        credit = Credit(self.data)
+        unpickled = pickle.loads(pickle.dumps(credit))
+        self.assertEqual(unpickled, credit)
+        self.assertEqual(unpickled.received_at, credit.received_at)
+        self.assertEqual(unpickled['source'], 'online')
+
+
+class NomisSessionPoolTestCase(SimpleTestCase):
+    def test_session_is_shared(self):
+        pool = NomisSessionPool()
+        session = pool.get_session()
+        self.assertIs(pool.get_session(), session)
+        self.assertIsInstance(session.get_adapter('https://prison-api.local/'), NomisHTTPAdapter)
+
+    def test_pool_records_hits_and_misses(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # noqa
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%s/' % server.server_port
+
+        session = NomisSessionPool().get_session()
+        self.addCleanup(session.close)
+        misses = nomis_pool_miss_counter._value.get()
+        hits = nomis_pool_hit_counter._value.get()
+        session.get(url)
+        self.assertEqual(nomis_pool_miss_counter._value.get(), misses + 1)
+        # the kept-alive connection is reused
+        session.get(url)
+        self.assertEqual(nomis_pool_hit_counter._value.get(), hits + 1)
+        self.assertEqual(nomis_pool_miss_counter._value.get(), misses + 1)
+
+
+@override_settings(
+    NOMIS_CIRCUIT_WINDOW=30, NOMIS_CIRCUIT_MIN_CALLS=4, NOMIS_CIRCUIT_FAILURE_RATE=0.5,
+    NOMIS_CIRCUIT_SLOW_CALL=10, NOMIS_CIRCUIT_BACKOFF=5, NOMIS_CIRCUIT_MAX_BACKOFF=60,
+    NOMIS_CONCURRENCY_LIMIT=4,
+)
+class NomisCircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000
+        patcher = mock.patch('mtp_cashbook.nomis_utils.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        nomis_circuit_breaker.reset()
+        nomis_concurrency_limiter.reset()
+        self.addCleanup(nomis_circuit_breaker.reset)
+        self.addCleanup(nomis_concurrency_limiter.reset)
+
+    def fail_call(self):
+        self.fail_with_status(503)
+
+    def fail_with_status(self, status_code):
+        raise HTTPError(response=mock.Mock(status_code=status_code))
+
+    def call(self, func):
+        try:
+            return call_nomis(func)
+        except RequestException:
+            pass
+
+    def test_opens_on_failure_rate_and_closes_after_successful_trial(self):
+        self.call(lambda: 'ok')
+        self.call(lambda: 'ok')
+        self.call(self.fail_call)
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.closed)
+        # client errors do not count as failures
+        self.call(lambda: self.fail_with_status(400))
+        self.call(self.fail_call)
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.closed)
+        self.call(self.fail_call)
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.open)
+
+        func = mock.Mock()
+        with self.assertRaises(NomisUnavailable):
+            call_nomis(func)
+        func.assert_not_called()
+
+        self.now += 5
+        self.assertEqual(call_nomis(lambda: 'ok'), 'ok')
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.closed)
+
+    def test_backoff_doubles_after_failed_trial(self):
+        for _ in range(4):
+            self.call(self.fail_call)
+        self.assertEqual(nomis_circuit_breaker.backoff, 5)
+        self.now += 5
+        self.call(self.fail_call)
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.open)
+        self.assertEqual(nomis_circuit_breaker.backoff, 10)
+        self.now += 9
+        with self.assertRaises(NomisUnavailable):
+            call_nomis(lambda: 'ok')
+        self.now += 1
+        self.assertEqual(call_nomis(lambda: 'ok'), 'ok')
+
+    def test_unexpected_errors_fail_trial(self):
+        for _ in range(4):
+            self.call(self.fail_call)
+        self.now += 5
+        with self.assertRaises(ValueError):
+            call_nomis(mock.Mock(side_effect=ValueError('invalid json')))
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.open)
+        self.assertEqual(nomis_circuit_breaker.backoff, 10)
+
+    @override_settings(NOMIS_CIRCUIT_WINDOW=100)
+    def test_slow_calls_count_as_failures(self):
+        def slow():
+            self.now += 11
+            return 'slow'
+
+        for _ in range(4):
+            self.assertEqual(call_nomis(slow), 'slow')
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.open)
+
+    def test_concurrency_limit_adapts(self):
+        self.call(lambda: 'ok')
+        self.assertEqual(nomis_concurrency_limiter.limit, 4)
+        self.call(self.fail_call)
+        self.assertEqual(nomis_concurrency_limiter.limit, 2)
+        self.call(self.fail_call)
+        self.call(self.fail_call)
+        self.assertEqual(nomis_concurrency_limiter.limit, 1)
+        nomis_circuit_breaker.reset()
+        for _ in range(5):
+            self.call(lambda: 'ok')
+        self.assertGreaterEqual(nomis_concurrency_limiter.limit, 3)
+        self.assertEqual(nomis_concurrency_limiter.in_flight, 0)
+
+    @override_settings(NOMIS_CONCURRENCY_LIMIT=1, NOMIS_CONCURRENCY_WAIT=0)
+    def test_waiting_for_concurrency_limit_times_out(self):
+        nomis_concurrency_limiter.acquire()
+        func = mock.Mock()
+        with self.assertRaises(NomisUnavailable):
+            call_nomis(func)
+        func.assert_not_called()
+        nomis_concurrency_limiter.release(False)
+        self.assertEqual(nomis_concurrency_limiter.in_flight, 0)
+        self.assertEqual(nomis_circuit_breaker.state, nomis_circuit_breaker.closed)
+
+
+@override_settings(SHARED_CACHE=True)
+class LocationCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @mock.patch(
+        'mtp_cashbook.nomis_utils.nomis.get_location',
+        return_value={'nomis_id': 'BXI', 'name': 'HMP BRIXTON'},
+    )
+    def test_location_is_cached_until_invalidated(self, mock_get_location):
+        hits = location_cache_hit_counter._value.get()
+        self.assertEqual(get_location('A1234BC')['nomis_id'], 'BXI')
+        self.assertEqual(get_location('A1234BC')['nomis_id'], 'BXI')
+        self.assertEqual(mock_get_location.call_count, 1)
+        self.assertEqual(location_cache_hit_counter._value.get(), hits + 1)
+
+        invalidate_location('A1234BC')
+        get_location('A1234BC')
+        self.assertEqual(mock_get_location.call_count, 2)
+
+    @override_settings(NOMIS_LOCATION_CACHE_TTL=0)
+    @mock.patch(
+        'mtp_cashbook.nomis_utils.nomis.get_location',
+        return_value={'nomis_id': 'BXI', 'name': 'HMP BRIXTON'},
+    )
+    def test_location_cache_can_be_disabled(self, mock_get_location):
+        get_location('A1234BC')
+        get_location('A1234BC')
+        self.assertEqual(mock_get_location.call_count, 2)
+
+    @override_settings(SHARED_CACHE=False)
+    @mock.patch(
+        'mtp_cashbook.nomis_utils.nomis.get_location',
+        return_value={'nomis_id': 'BXI', 'name': 'HMP BRIXTON'},
+    )
+    def test_location_is_not_cached_in_process_cache(self, mock_get_location):
+        get_location('A1234BC')
+        get_location('A1234BC')
+        self.assertEqual(mock_get_location.call_count, 2)
+        self.assertIsNone(cache.get('nomis-location-A1234BC'))
+
+
+class AccountBalancesSnapshotTestCase(SimpleTestCase):
+    balances = {'cash': 1000, 'spends': 200, 'savings': 0}
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @override_settings(SHARED_CACHE=True)
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_account_balances', return_value=balances)
+    def test_snapshot_is_cached_until_invalidated(self, mock_get_account_balances):
+        self.assertDictEqual(get_account_balances('BXI', 'A1234BC'), self.balances)
+        self.assertDictEqual(get_account_balances('BXI', 'A1234BC'), self.balances)
+        self.assertEqual(mock_get_account_balances.call_count, 1)
+
+        invalidate_account_balances('BXI', 'A1234BC')
+        get_account_balances('BXI', 'A1234BC')
+        self.assertEqual(mock_get_account_balances.call_count, 2)
+
+    @override_settings(SHARED_CACHE=False)
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_account_balances', return_value=balances)
+    def test_snapshot_is_reused_within_request(self, mock_get_account_balances):
+        request = mock.Mock(spec=[])
+        get_account_balances('BXI', 'A1234BC', request=request)
+        get_account_balances('BXI', 'A1234BC', request=request)
+        self.assertEqual(mock_get_account_balances.call_count, 1)
+
+        get_account_balances('BXI', 'A1234BC', request=mock.Mock(spec=[]))
+        self.assertEqual(mock_get_account_balances.call_count, 2)
+
+        invalidate_account_balances('BXI', 'A1234BC', request=request)
+        get_account_balances('BXI', 'A1234BC', request=request)
+        self.assertEqual(mock_get_account_balances.call_count, 3)
@@ -1,20 +1,30 @@
 import json
-from datetime import datetime
+from datetime import date, datetime
 from unittest import mock
 import logging
+import time
+from urllib.parse import quote
 
 from django.core import mail
 from django.test import override_settings
 from django.urls import reverse
+from django.utils.functional import cached_property
+from mtp_common.auth.test_utils import generate_tokens
 from mtp_common.test_utils import silence_logger
 from requests.exceptions import HTTPError
 import responses
 
+from cashbook.forms import (
+    FilterProcessedCreditsListForm, dump_processed_credits_cursor, dump_select_all_digest, get_credit_ids_digest,
+    load_processed_credits_cursor,
+)
+from cashbook.progress import CreditingProgress
 from cashbook.tests import (
     api_url,
     MTPBaseTestCase,
     wrap_response_data,
 )
+from mtp_cashbook.result_cache import invalidate_cached_results
 
 CREDIT_1 = {
     'id': 1,
@@ -113,25 +123,13 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
             # create batch
             rsps.add(
                 rsps.POST,
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # credit credits to API
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -145,22 +143,6 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(PROCESSING_BATCH),
                 status=200,
             )
-            # get incomplete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get complete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=credited&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
-                status=200,
-                match_querystring=True,
-            )
             # delete completed batch
             rsps.add(
                 rsps.DELETE,
@@ -191,13 +173,12 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 follow=True
             )
             self.assertEqual(response.status_code, 200)
-            expected_calls = [
-                [{'id': 1, 'credited': True, 'nomis_transaction_id': 'A1234BC-1'}],
-                [{'id': 2, 'credited': True, 'nomis_transaction_id': 'A1234GG-1'}]
-            ]
-            self.assertTrue(
-                json.loads(rsps.calls[3].request.body.decode('utf-8')) in expected_calls and
-                json.loads(rsps.calls[4].request.body.decode('utf-8')) in expected_calls
+            self.assertCountEqual(
+                json.loads(rsps.calls[2].request.body.decode('utf-8')),
+                [
+                    {'id': 1, 'credited': True, 'nomis_transaction_id': 'A1234BC-1'},
+                    {'id': 2, 'credited': True, 'nomis_transaction_id': 'A1234GG-1'},
+                ]
             )
 
             request_nomis_session_used = mock_create_transaction.call_args_list[0][1]['session']
@@ -243,8 +224,9 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
         PRISONER_CAPPING_THRESHOLD_IN_POUNDS=100,
     )
     @mock.patch('cashbook.tasks.logger')
-    @mock.patch('cashbook.tasks.nomis')
-    def test_balance_check_after_credit(self, mock_nomis, mock_logger):
+    @mock.patch('mtp_common.nomis.get_account_balances')
+    @mock.patch('mtp_common.nomis.create_transaction')
+    def test_balance_check_after_credit(self, mock_create_transaction, mock_get_account_balances, mock_logger):
         balances = {
             # credit 1 – £52 – within cap
             'A1234BC': {'cash': 800, 'spends': 0, 'savings': 4000},
@@ -258,12 +240,12 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
             balances[prisoner_number]['cash'] += amount
             return {'id': f'{prisoner_number}-1'}
 
-        def get_account_balances(prison, prisoner_number):
+        def get_account_balances(prison, prisoner_number, session):
             self.assertEqual(prison, 'BXI', msg='Unexpected test data')
             return balances[prisoner_number]
 
-        mock_nomis.create_transaction = create_transaction
-        mock_nomis.get_account_balances = get_account_balances
+        mock_create_transaction.side_effect = create_transaction
+        mock_get_account_balances.side_effect = get_account_balances
 
         with responses.RequestsMock() as rsps:
             # get new credits
@@ -274,25 +256,13 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
             # create batch
             rsps.add(
                 rsps.POST,
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # credit credits to API
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -306,22 +276,6 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(PROCESSING_BATCH),
                 status=200,
             )
-            # get incomplete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get complete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=credited&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
-                status=200,
-                match_querystring=True,
-            )
             # delete completed batch
             rsps.add(
                 rsps.DELETE,
@@ -376,25 +330,13 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
             # create batch
             rsps.add(
                 rsps.POST,
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # credit credits to API
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -408,22 +350,6 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(PROCESSING_BATCH),
                 status=200,
             )
-            # get incomplete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get complete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=credited&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
-                status=200,
-                match_querystring=True,
-            )
             # delete completed batch
             rsps.add(
                 rsps.DELETE,
@@ -483,14 +409,6 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
             # create batch
             rsps.add(
                 rsps.POST,
@@ -516,22 +434,6 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(PROCESSING_BATCH),
                 status=200,
             )
-            # get incomplete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get complete credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=credited&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_2),
-                status=200,
-                match_querystring=True,
-            )
             # delete completed batch
             rsps.add(
                 rsps.DELETE,
@@ -569,7 +471,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
 
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to .local
     @mock.patch(
-        'cashbook.views.nomis.get_location',
+        'mtp_cashbook.nomis_utils.nomis.get_location',
         return_value={
             'nomis_id': 'LEI',
             'name': 'LEEDS (HMP)',
@@ -577,19 +479,11 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
     )
     def test_manual_credits_submit(self, _):
         with responses.RequestsMock() as rsps:
-            # get new credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
+            # check manual credit
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                api_url('/credits/?pk=1&resolution=manual&status=credit_pending&limit=1'),
+                json=wrap_response_data(CREDIT_1),
                 status=200,
                 match_querystring=True,
             )
@@ -631,175 +525,457 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 follow=True
             )
             self.assertEqual(
-                json.loads(rsps.calls[2].request.body.decode('utf-8')),
+                json.loads(rsps.calls[1].request.body.decode('utf-8')),
                 [{'id': 1, 'credited': True}]
             )
             self.assertEqual(response.status_code, 200)
             self.assertContains(response, '1 credit manually input by you into NOMIS')
 
-
-@mock.patch(
-    'cashbook.views.nomis.get_location',
-    mock.Mock(
-        return_value={
-            'nomis_id': 'LEI',
-            'name': 'LEEDS (HMP)',
-        },
-    ),
-)
-class ProcessingCreditsViewTestCase(MTPBaseTestCase):
-
-    @property
-    def url(self):
-        return reverse('processing-credits')
-
-    def test_new_credits_redirects_to_processing_when_batch_active(self):
+    def test_manual_credits_submit_unavailable_credit(self):
         with responses.RequestsMock() as rsps:
-            # get active batches
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/batches/'),
-                json=wrap_response_data(PROCESSING_BATCH),
-                status=200,
-            )
-            # get incomplete credits
+            # check manual credit
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                api_url('/credits/?pk=3&resolution=manual&status=credit_pending&limit=1'),
+                json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
             )
-            # get active batches
+            # get new credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/batches/'),
-                json=wrap_response_data(PROCESSING_BATCH),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(),
                 status=200,
+                match_querystring=True,
             )
-            # get incomplete credits
+            # get manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-
             self.login()
-            response = self.client.get(reverse('new-credits'), follow=True)
-            self.assertRedirects(response, self.url)
+            response = self.client.post(self.url, data={'submit_manual_3': ''})
+            self.assertContains(response, 'That credit cannot be manually credited')
+            self.assertEqual(len(rsps.calls), 3)
 
-    def test_processing_credits_displays_percentage(self):
+    def test_new_credits_invalid_submit_loads_credits_once(self):
         with responses.RequestsMock() as rsps:
-            # get active batches
+            # get new credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/batches/'),
-                json=wrap_response_data(PROCESSING_BATCH),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
+                match_querystring=True,
             )
-            # get incomplete credits
+            # get manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_2),
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
             )
-
             self.login()
-            response = self.client.get(reverse('processing-credits'), follow=True)
-            self.assertContains(response, '50%')
+            response = self.client.post(self.url, data={'credits': [], 'submit_new': 'submit'})
+            self.assertContains(response, 'Only click ‘Credit to NOMIS’ when you’ve selected credits')
+            self.assertContains(response, '52.00')
+            self.assertEqual(len(rsps.calls), 2)
 
-    def test_processing_credits_displays_continue_when_done(self):
+    def test_new_credits_summary(self):
+        unowned_credit = dict(CREDIT_2, owner=101, owner_name='Staff 2')
         with responses.RequestsMock() as rsps:
-            # get active batches
             rsps.add(
                 rsps.GET,
                 api_url('/credits/batches/'),
-                json=wrap_response_data(PROCESSING_BATCH),
+                json=wrap_response_data(),
                 status=200,
             )
-            # get incomplete credits
+            # get new credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(dict(CREDIT_2, id=4), dict(CREDIT_1, id=3, received_at='2017-01-20T12:00:00Z')),
+                status=200,
+                match_querystring=True,
+            )
+            # get manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(CREDIT_1, unowned_credit),
                 status=200,
                 match_querystring=True,
             )
-
             self.login()
-            response = self.client.get(reverse('processing-credits'), follow=True)
-            self.assertContains(response, 'Continue')
+            response = self.client.get(self.url)
+        context = response.context
+        self.assertEqual(context['new_credits'], 2)
+        self.assertEqual(context['total'], 9700)
+        self.assertEqual(context['new_oldest_date'].date(), datetime(2017, 1, 20).date())
+        self.assertEqual(context['new_latest_date'].date(), datetime(2017, 1, 25).date())
+        self.assertEqual(context['manual_credits'], 2)
+        self.assertEqual(context['owned_manual_credits'], 1)
+        self.assertEqual(context['unowned_manual_credits'], 1)
+        self.assertListEqual(context['other_owners'], ['Staff 2'])
+        self.assertEqual(context['unowned_oldest_date'].date(), datetime(2017, 1, 26).date())
+        self.assertListEqual([credit_id for credit_id, _credit in context['owned_manual_object_list']], [1])
+        self.assertListEqual([credit_id for credit_id, _credit in context['unowned_manual_object_list']], [2])
 
-    def test_processing_credits_redirects_to_new_for_expired_batch(self):
+    @override_settings(NEW_CREDITS_PAGE_SIZE=1)
+    def test_new_credits_paginated_display(self):
         with responses.RequestsMock() as rsps:
             # get active batches
             rsps.add(
                 rsps.GET,
                 api_url('/credits/batches/'),
-                json=wrap_response_data(EXPIRED_PROCESSING_BATCH),
+                json=wrap_response_data(),
                 status=200,
             )
-            # get active batches
+            # get manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/batches/'),
-                json=wrap_response_data(EXPIRED_PROCESSING_BATCH),
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(),
                 status=200,
+                match_querystring=True,
             )
-            # get incomplete credits
+            # get page of new credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=pending&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_2),
+                api_url('/credits/?ordering=-received_at&offset=1&limit=1&status=credit_pending&resolution=pending'),
+                json={'count': 2, 'results': [CREDIT_2]},
                 status=200,
                 match_querystring=True,
             )
-            # get complete credits
+            # summarise all new credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=credited&pk=1&pk=2'),
-                json=wrap_response_data(CREDIT_1),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
+            self.login()
+            response = self.client.get(self.url, {'page': 2})
+            self.assertContains(response, '45.00')
+            self.assertNotContains(response, '52.00')
+            self.assertContains(response, 'Select all 2 credits, including those on other pages')
+            self.assertContains(response, 'name="select_all_digest"')
+            self.assertContains(response, 'Total £97.00, oldest received on')
+            self.assertEqual(response.context['new_credits'], 2)
+            self.assertEqual(response.context['new_latest_date'].date(), datetime(2017, 1, 25).date())
+            self.assertEqual(response.context['form']['new'].summary['digest'], get_credit_ids_digest([1, 2]))
+
+    @override_settings(NEW_CREDITS_PAGE_SIZE=1, RESULT_CACHE_TTL=30)
+    def test_new_credits_paginated_summary_is_cached(self):
+        def add_page(rsps, offset, credit):
             rsps.add(
-                rsps.DELETE,
-                api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
+                rsps.GET,
+                api_url(f'/credits/?ordering=-received_at&offset={offset}&limit=1&status=credit_pending'
+                        '&resolution=pending'),
+                json={'count': 2, 'results': [credit]},
                 status=200,
+                match_querystring=True,
             )
-            # get new credits
+
+        def add_batches_and_manual_credits(rsps):
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/batches/'),
                 json=wrap_response_data(),
                 status=200,
-                match_querystring=True,
             )
-            # get manual credits
             rsps.add(
                 rsps.GET,
                 api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_2),
+                json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
             )
 
+        with responses.RequestsMock() as rsps:
+            add_batches_and_manual_credits(rsps)
+            add_page(rsps, 0, CREDIT_1)
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
             self.login()
-            response = self.client.get(self.url, follow=True)
-            self.assertRedirects(response, reverse('new-credits'))
-
+            response = self.client.get(self.url, {'page': 1})
+            self.assertEqual(response.context['new_credits'], 2)
 
-class ProcessedCreditsListViewTestCase(MTPBaseTestCase):
-
-    @property
-    def url(self):
-        return reverse('processed-credits-list')
+        # moving to another page only loads that page
+        with responses.RequestsMock() as rsps:
+            add_batches_and_manual_credits(rsps)
+            add_page(rsps, 1, CREDIT_2)
+            response = self.client.get(self.url, {'page': 2})
+            self.assertContains(response, 'Select all 2 credits, including those on other pages')
+            self.assertEqual(response.context['form']['new'].summary['digest'], get_credit_ids_digest([1, 2]))
 
-    def test_processed_credits_list_view(self):
+    @override_settings(ENVIRONMENT='prod', NEW_CREDITS_PAGE_SIZE=1)
+    @mock.patch(
+        'cashbook.tasks.nomis.create_transaction',
+        side_effect=lambda **kwargs: {'id': f'{kwargs["prisoner_number"]}-1'},
+    )
+    def test_new_credits_submit_all_pages(self, _):
+        with responses.RequestsMock() as rsps:
+            # get all new credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+            # credit credits to API
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/actions/credit/'),
+                status=204,
+            )
+            self.login()
+            response = self.client.post(self.url, data={
+                'select_all_pages': 'on', 'select_all_digest': dump_select_all_digest(get_credit_ids_digest([1, 2])),
+                'submit_new': 'submit',
+            })
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+            self.assertCountEqual(json.loads(rsps.calls[1].request.body.decode())['credits'], [1, 2])
+            self.assertCountEqual(
+                [credit_update['id'] for credit_update in json.loads(rsps.calls[2].request.body.decode())],
+                [1, 2],
+            )
+
+    @override_settings(NEW_CREDITS_PAGE_SIZE=1)
+    def test_new_credits_submit_all_pages_rejected_if_credits_changed(self):
+        with responses.RequestsMock() as rsps:
+            # get all new credits, now with an older one that the user was not shown in place of one processed since
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_1, dict(CREDIT_2, id=3, received_at='2017-01-20T12:00:00Z')),
+                status=200,
+                match_querystring=True,
+            )
+            # re-render page of new credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=1&status=credit_pending&resolution=pending'),
+                json={'count': 2, 'results': [CREDIT_1]},
+                status=200,
+                match_querystring=True,
+            )
+            # get manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(),
+                status=200,
+                match_querystring=True,
+            )
+            self.login()
+            response = self.client.post(self.url, data={
+                'select_all_pages': 'on', 'select_all_digest': dump_select_all_digest(get_credit_ids_digest([1, 2])),
+                'submit_new': 'submit',
+            })
+            self.assertContains(response, 'New credits have changed since you loaded this page')
+            self.assertContains(response, 'Select all 2 credits, including those on other pages')
+            for call in rsps.calls:
+                self.assertEqual(call.request.method, 'GET')
+
+
+@mock.patch(
+    'mtp_cashbook.nomis_utils.nomis.get_location',
+    mock.Mock(
+        return_value={
+            'nomis_id': 'LEI',
+            'name': 'LEEDS (HMP)',
+        },
+    ),
+)
+class ProcessingCreditsViewTestCase(MTPBaseTestCase):
+
+    @property
+    def url(self):
+        return reverse('processing-credits')
+
+    @cached_property
+    def progress(self):
+        return CreditingProgress(self._default_login_data['user_pk'])
+
+    def add_batches(self, rsps, batch=PROCESSING_BATCH):
+        # get active batches
+        rsps.add(
+            rsps.GET,
+            api_url('/credits/batches/'),
+            json=wrap_response_data(*filter(None, [batch])),
+            status=200,
+        )
+
+    def test_new_credits_redirects_to_processing_when_batch_active(self):
+        self.progress.start(2)
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps)
+
+            self.login()
+            response = self.client.get(reverse('new-credits'), follow=True)
+            self.assertRedirects(response, self.url)
+
+    def test_processing_credits_displays_percentage(self):
+        self.progress.start(2)
+        self.progress.add('credited')
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps)
+
+            self.login()
+            response = self.client.get(reverse('processing-credits'), follow=True)
+            self.assertContains(response, '50%')
+
+    def test_processing_credits_displays_continue_when_done(self):
+        self.progress.start(2)
+        self.progress.add('credited')
+        self.progress.add('manual')
+        with responses.RequestsMock():
+            self.login()
+            response = self.client.get(reverse('processing-credits'), follow=True)
+            self.assertContains(response, 'Continue')
+
+    def test_processing_credits_waits_for_batch_without_progress(self):
+        # progress is unknown if it is counted on another host so the batch is only over once it expires
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps)
+
+            self.login()
+            response = self.client.get(reverse('processing-credits'), follow=True)
+            self.assertContains(response, '0%')
+
+    def test_processing_credits_redirects_to_new_for_expired_batch(self):
+        self.progress.start(2)
+        self.progress.add('credited')
+        self.progress.add('failed')
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps, EXPIRED_PROCESSING_BATCH)
+            rsps.add(
+                rsps.DELETE,
+                api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
+                status=200,
+            )
+            # get new credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                json=wrap_response_data(CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # get manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                json=wrap_response_data(),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.get(self.url, follow=True)
+            self.assertRedirects(response, reverse('new-credits'))
+            self.assertContains(response, '1 credit sent to NOMIS')
+            self.assertContains(response, '1 credit not processed due to technical error')
+        self.assertIsNone(self.progress.get())
+
+
+class ProcessingCreditsProgressViewTestCase(MTPBaseTestCase):
+
+    @property
+    def url(self):
+        return reverse('processing-credits-progress')
+
+    @cached_property
+    def progress(self):
+        return CreditingProgress(self._default_login_data['user_pk'])
+
+    def add_batches(self, rsps, batch=PROCESSING_BATCH):
+        # get active batches
+        rsps.add(
+            rsps.GET,
+            api_url('/credits/batches/'),
+            json=wrap_response_data(*filter(None, [batch])),
+            status=200,
+        )
+
+    def test_progress(self):
+        self.progress.start(4)
+        self.progress.add('credited', 2)
+        self.progress.add('manual')
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps)
+            self.login()
+            response = self.client.get(self.url)
+            # the batch's credits are not queried
+            self.assertEqual(len(rsps.calls), 1)
+        self.assertDictEqual(response.json(), {
+            'total': 4, 'credited': 2, 'manual': 1, 'failed': 0,
+            'done': 3, 'percentage': 75, 'complete': False,
+        })
+
+    def test_complete_progress_does_not_query_api(self):
+        self.progress.start(2)
+        self.progress.add('credited', 2)
+        with responses.RequestsMock():
+            self.login()
+            response = self.client.get(self.url)
+        self.assertTrue(response.json()['complete'])
+
+    def test_progress_without_active_batch(self):
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps, None)
+            self.login()
+            response = self.client.get(self.url)
+        self.assertTrue(response.json()['complete'])
+
+    def test_progress_is_not_complete_while_failed_credits_are_pending(self):
+        self.progress.start(2)
+        self.progress.add('credited')
+        self.progress.add('failed')
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps)
+            self.login()
+            response = self.client.get(self.url)
+        self.assertEqual(response.json()['percentage'], 50)
+        self.assertFalse(response.json()['complete'])
+
+    def test_progress_with_failed_credits_is_complete_once_batch_expires(self):
+        self.progress.start(2)
+        self.progress.add('credited')
+        self.progress.add('failed')
+        with responses.RequestsMock() as rsps:
+            self.add_batches(rsps, EXPIRED_PROCESSING_BATCH)
+            self.login()
+            response = self.client.get(self.url)
+        self.assertTrue(response.json()['complete'])
+
+
+class ProcessedCreditsListViewTestCase(MTPBaseTestCase):
+
+    @property
+    def url(self):
+        return reverse('processed-credits-list')
+
+    def test_processed_credits_list_view(self):
         with responses.RequestsMock() as rsps:
             self.login()
 
@@ -846,6 +1022,199 @@ class ProcessedCreditsListViewTestCase(MTPBaseTestCase):
             self.assertContains(response, text='4 credits')
             self.assertContains(response, text='5 credits')
 
+    @override_settings(RESULT_CACHE_TTL=30)
+    def test_processed_credits_are_cached_until_user_credits(self):
+        with responses.RequestsMock() as rsps:
+            self.login()
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/'),
+                json={
+                    'count': 1,
+                    'results': [{
+                        'logged_at': '2017-06-04', 'owner': 1, 'owner_name': 'Clerk 1',
+                        'count': 10, 'total': 10500, 'comment_count': 0,
+                    }],
+                },
+                status=200,
+            )
+            self.assertContains(self.client.get(self.url), text='10 credits')
+            self.assertContains(self.client.get(self.url), text='10 credits')
+            self.assertEqual(len(rsps.calls), 1)
+
+            invalidate_cached_results(mock.Mock(pk=self._default_login_data['user_pk']))
+            self.assertContains(self.client.get(self.url), text='10 credits')
+            self.assertEqual(len(rsps.calls), 2)
+
+    @override_settings(PROCESSED_CREDITS_KEYSET_PAGINATION=True)
+    def test_keyset_pagination(self):
+        def batches(days, owners):
+            return [
+                {
+                    'logged_at': '2017-06-%02d' % day, 'owner': owner, 'owner_name': 'Clerk %s' % owner,
+                    'count': 1, 'total': 1000, 'comment_count': 0,
+                }
+                for day in days
+                for owner in owners
+            ]
+
+        with responses.RequestsMock() as rsps:
+            self.login()
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=0&limit=20'),
+                json={'count': 27, 'results': batches(range(10, 4, -1), (3, 2, 1)) + batches([4], (3, 2))},
+                match_querystring=True,
+                status=200,
+            )
+            # continues from the 3rd batch of the 4th of June regardless of how many batches came before
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=2&limit=20&logged_at__lt=2017-06-05'),
+                json={'count': 9, 'results': batches([4], (1,)) + batches(range(3, 1, -1), (3, 2, 1))},
+                match_querystring=True,
+                status=200,
+            )
+
+            response = self.client.get(self.url)
+            pagination = response.context['form'].pagination
+            self.assertEqual(pagination['page_count'], 2)
+            self.assertIsNone(pagination['previous_cursor'])
+            self.assertEqual(load_processed_credits_cursor(pagination['next_cursor']), (2, (date(2017, 6, 4), 2)))
+            self.assertContains(response, 'Page 1 of 2')
+            self.assertContains(response, '?cursor=%s' % quote(pagination['next_cursor']))
+
+            response = self.client.get(self.url, data={'cursor': pagination['next_cursor']})
+            pagination = response.context['form'].pagination
+            self.assertEqual(pagination['page'], 2)
+            self.assertEqual(pagination['page_count'], 2)
+            self.assertEqual(pagination['count'], 27)
+            self.assertEqual(pagination['previous_cursor'], '')
+            self.assertIsNone(pagination['next_cursor'])
+            self.assertEqual(len(response.context['object_list']), 7)
+            self.assertContains(response, 'Page 2 of 2')
+
+    @override_settings(PROCESSED_CREDITS_KEYSET_PAGINATION=True)
+    @mock.patch.object(FilterProcessedCreditsListForm, 'page_size', 2)
+    def test_keyset_pagination_finds_previous_page(self):
+        def batches(day, *owners):
+            return [
+                {
+                    'logged_at': '2017-06-%02d' % day, 'owner': owner, 'owner_name': 'Clerk %s' % owner,
+                    'count': 1, 'total': 1000, 'comment_count': 0,
+                }
+                for owner in owners
+            ]
+
+        def add_response(rsps, query, count, results):
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?%s' % query),
+                json={'count': count, 'results': results},
+                match_querystring=True,
+                status=200,
+            )
+
+        # pages of 2 batches: 10th (owners 1, 2) | 10th (3), 8th (1) | 5th (1, 2) | 4th (1), 3rd (1)
+        with responses.RequestsMock() as rsps:
+            self.login()
+            add_response(rsps, 'offset=1&limit=2&logged_at__lt=2017-06-09', 5, batches(5, 1, 2))
+            # the oldest batch after the 8th is found by counting batches in widening windows of days
+            window = 'logged_at__gte=2017-06-09&logged_at__lt=2017-06-%s'
+            add_response(rsps, 'offset=0&limit=2&' + window % 10, 0, [])
+            add_response(rsps, 'offset=0&limit=2&' + window % 11, 3, batches(10, 1, 2))
+            add_response(rsps, 'offset=2&limit=1&' + window % 11, 3, batches(10, 3))
+            add_response(rsps, 'offset=0&limit=1&logged_at__gte=2017-06-11&logged_at__lt=2017-06-11', 0, [])
+
+            cursor = dump_processed_credits_cursor(3, (date(2017, 6, 8), 1))
+            response = self.client.get(self.url, data={'cursor': cursor})
+            pagination = response.context['form'].pagination
+            self.assertEqual(pagination['page'], 3)
+            self.assertEqual(pagination['page_count'], 4)
+            self.assertEqual(pagination['count'], 8)
+            self.assertEqual(load_processed_credits_cursor(pagination['previous_cursor']), (2, (date(2017, 6, 10), 2)))
+            self.assertEqual(load_processed_credits_cursor(pagination['next_cursor']), (4, (date(2017, 6, 5), 2)))
+
+        with responses.RequestsMock() as rsps:
+            # the previous page starts on the same day so no more batches need to be counted
+            add_response(rsps, 'offset=2&limit=2&logged_at__lt=2017-06-06', 4, batches(4, 1) + batches(3, 1))
+
+            response = self.client.get(self.url, data={'cursor': pagination['next_cursor']})
+            pagination = response.context['form'].pagination
+            self.assertEqual(pagination['page'], 4)
+            self.assertEqual(pagination['page_count'], 4)
+            self.assertEqual(load_processed_credits_cursor(pagination['previous_cursor']), (3, (date(2017, 6, 5), 0)))
+            self.assertIsNone(pagination['next_cursor'])
+            self.assertEqual(len(response.context['object_list']), 2)
+
+    def test_invalid_cursor_is_ignored(self):
+        self.assertEqual(load_processed_credits_cursor('2017-06-04:2'), (1, None))
+        self.assertEqual(load_processed_credits_cursor(''), (1, None))
+
+    @override_settings(RESULT_CACHE_TTL=30, RESULT_PREFETCH=True)
+    @mock.patch('mtp_cashbook.result_cache.get_prefetch_executor', return_value=mock.Mock(submit=lambda func: func()))
+    def test_next_page_is_prefetched(self, _):
+        def processed_credits(owner_name):
+            return {
+                'count': 21,
+                'results': [{
+                    'logged_at': '2017-06-04', 'owner': 1, 'owner_name': owner_name,
+                    'count': 10, 'total': 10500, 'comment_count': 0,
+                }],
+            }
+
+        with responses.RequestsMock() as rsps:
+            self.login()
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=0&limit=20'),
+                json=processed_credits('Clerk 1'),
+                match_querystring=True,
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=20&limit=20'),
+                json=processed_credits('Clerk 2'),
+                match_querystring=True,
+                status=200,
+            )
+            self.assertContains(self.client.get(self.url), text='Clerk 1')
+            self.assertEqual(len(rsps.calls), 2)
+            self.assertContains(self.client.get(self.url, data={'page': 2}), text='Clerk 2')
+            self.assertEqual(len(rsps.calls), 2)
+
+    @override_settings(RESULT_CACHE_TTL=30, RESULT_PREFETCH=True)
+    def test_next_page_is_prefetched_after_response(self):
+        prefetches = []
+        executor = mock.Mock(submit=prefetches.append)
+        with responses.RequestsMock() as rsps, \
+                mock.patch('mtp_cashbook.result_cache.get_prefetch_executor', return_value=executor):
+            self.login()
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=0&limit=20'),
+                json={'count': 21, 'results': []},
+                match_querystring=True,
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/processed/?offset=20&limit=20'),
+                body='not json',
+                match_querystring=True,
+                status=200,
+            )
+            self.client.get(self.url)
+            self.assertEqual(len(rsps.calls), 1)
+            self.assertEqual(len(prefetches), 1)
+
+            with mock.patch('mtp_cashbook.result_cache.logger') as logger:
+                prefetches[0]()
+            self.assertEqual(len(rsps.calls), 2)
+            self.assertTrue(rsps.calls[1].request.headers['Authorization'].startswith('Bearer '))
+            logger.exception.assert_called_once()
+
     def test_processed_credits_list_view_no_results(self):
         with responses.RequestsMock() as rsps:
             self.login()
@@ -951,6 +1320,135 @@ class ProcessedCreditsDetailViewTestCase(MTPBaseTestCase):
             self.assertEqual(response.status_code, 200)
             self.assertContains(response, text='No credits')
 
+    def test_processed_credits_detail_view_is_paginated(self):
+        credit = {
+            'id': 142,
+            'prisoner_name': 'John Smith',
+            'prisoner_number': 'A1234BC',
+            'amount': 5200,
+            'sender_name': 'Fred Smith',
+            'prison': 'BXI',
+            'owner': 1,
+            'owner_name': 'Clerk 1',
+            'received_at': '2017-06-02T12:00:00Z',
+            'resolution': 'credited',
+            'credited_at': '2017-06-03T12:00:00Z',
+            'refunded_at': None,
+        }
+        with responses.RequestsMock() as rsps:
+            self.login()
+
+            rsps.add(
+                rsps.GET,
+                api_url(
+                    '/credits/?logged_at__gte=2017-06-03+00:00:00&limit=100'
+                    '&logged_at__lt=2017-06-04+00:00:00&user=1'
+                    '&log__action=credited&offset=100&ordering=-received_at'
+                ),
+                json={'count': 101, 'results': [credit]},
+                match_querystring=True,
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url(
+                    '/credits/processed/?limit=1&user=1'
+                    '&logged_at__gte=2017-06-03+00:00:00&logged_at__lt=2017-06-04+00:00:00'
+                ),
+                json={
+                    'count': 1,
+                    'results': [
+                        {'logged_at': '2017-06-03', 'owner': 1, 'owner_name': 'Clerk 1',
+                         'count': 101, 'total': 525200, 'comment_count': 0},
+                    ]
+                },
+                match_querystring=True,
+                status=200,
+            )
+
+            response = self.client.get(self.url, data={'page': 2})
+            self.assertContains(response, text='John Smith', count=1)
+            self.assertContains(response, text='101 credits processed')
+            self.assertContains(response, text='5,252.00')
+            self.assertContains(response, text='Page 2 of 2')
+
+    @override_settings(RESULT_CACHE_TTL=30)
+    def test_processed_credits_detail_view_batch_total_is_cached(self):
+        credit = {
+            'id': 142,
+            'prisoner_name': 'John Smith',
+            'prisoner_number': 'A1234BC',
+            'amount': 5200,
+            'sender_name': 'Fred Smith',
+            'prison': 'BXI',
+            'owner': 1,
+            'owner_name': 'Clerk 1',
+            'received_at': '2017-06-02T12:00:00Z',
+            'resolution': 'credited',
+            'credited_at': '2017-06-03T12:00:00Z',
+            'refunded_at': None,
+        }
+        pages = [[credit] * 100, [credit]]
+        with responses.RequestsMock() as rsps:
+            self.login()
+
+            for offset, credits in zip((0, 100), pages):
+                rsps.add(
+                    rsps.GET,
+                    api_url(
+                        '/credits/?logged_at__gte=2017-06-03+00:00:00&limit=100'
+                        '&logged_at__lt=2017-06-04+00:00:00&user=1'
+                        '&log__action=credited&offset=%d&ordering=-received_at' % offset
+                    ),
+                    json={'count': 101, 'results': credits},
+                    match_querystring=True,
+                    status=200,
+                )
+            rsps.add(
+                rsps.GET,
+                api_url(
+                    '/credits/processed/?limit=1&user=1'
+                    '&logged_at__gte=2017-06-03+00:00:00&logged_at__lt=2017-06-04+00:00:00'
+                ),
+                json={
+                    'count': 1,
+                    'results': [
+                        {'logged_at': '2017-06-03', 'owner': 1, 'owner_name': 'Clerk 1',
+                         'count': 101, 'total': 525200, 'comment_count': 0},
+                    ]
+                },
+                match_querystring=True,
+                status=200,
+            )
+
+            # the processed credits total is the sum of the batch's credited credits
+            self.assertEqual(sum(credit['amount'] for credits in pages for credit in credits), 525200)
+            for page in (1, 2):
+                response = self.client.get(self.url, data={'page': page})
+                self.assertContains(response, text='5,252.00')
+            processed_calls = [call for call in rsps.calls if '/credits/processed/' in call.request.url]
+            self.assertEqual(len(processed_calls), 1)
+
+    def test_filtered_processed_credits_detail_view_spanning_pages_has_no_total(self):
+        with responses.RequestsMock() as rsps:
+            self.login()
+
+            rsps.add(
+                rsps.GET,
+                api_url(
+                    '/credits/?logged_at__gte=2017-06-03+00:00:00&limit=100'
+                    '&logged_at__lt=2017-06-04+00:00:00&user=1&search=Smith'
+                    '&log__action=credited&offset=0&ordering=-received_at'
+                ),
+                json={'count': 101, 'results': []},
+                match_querystring=True,
+                status=200,
+            )
+
+            response = self.client.get(self.url, data={'names': 'Smith'})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotContains(response, text='Total:')
+
 
 class SearchViewTestCase(MTPBaseTestCase):
 
@@ -966,7 +1464,8 @@ class SearchViewTestCase(MTPBaseTestCase):
             # uncredited
             rsps.add(
                 rsps.GET,
-                api_url('/credits/'),
+                api_url('/credits/?offset=0&limit=100&status=credit_pending&ordering=-received_at&search=Smith'),
+                match_querystring=True,
                 json={
                     'count': 1,
                     'results': [
@@ -993,7 +1492,8 @@ class SearchViewTestCase(MTPBaseTestCase):
             # credited
             rsps.add(
                 rsps.GET,
-                api_url('/credits/'),
+                api_url('/credits/?offset=0&limit=20&resolution=credited&ordering=-received_at&search=Smith'),
+                match_querystring=True,
                 json={
                     'count': 2,
                     'results': [
@@ -1051,3 +1551,57 @@ class SearchViewTestCase(MTPBaseTestCase):
         ))
         self.assertIn('<strong>3</strong> credits', response.content.decode(response.charset))
         self.assertContains(response, text='John Smith', count=2)
+
+    @override_settings(SEARCH_NEW_CREDITS_LIMIT=1)
+    def test_new_credits_are_capped(self):
+        with responses.RequestsMock() as rsps:
+            self.login()
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?offset=0&limit=1&status=credit_pending&ordering=-received_at'),
+                match_querystring=True,
+                json={'count': 3, 'results': [dict(CREDIT_1, resolution='pending')]},
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?offset=0&limit=20&resolution=credited&ordering=-received_at'),
+                match_querystring=True,
+                json=wrap_response_data(),
+                status=200,
+            )
+            response = self.client.get(self.url, data={'ordering': '-received_at'})
+
+        self.assertContains(response, 'Showing 1 of 3 new credits')
+        self.assertContains(response, 'href="%s"' % reverse('new-credits'))
+        self.assertIn('<strong>3</strong> credits', response.content.decode(response.charset))
+
+    def test_expired_token_is_refreshed_once_before_requesting_credits(self):
+        new_token = generate_tokens(expires_in=36000, token_type='Bearer')
+        login_data = dict(
+            self._default_login_data,
+            token=generate_tokens(expires_at=time.time() - 60, expires_in=60, token_type='Bearer'),
+        )
+        with responses.RequestsMock() as rsps:
+            self.login(login_data=login_data)
+            rsps.add(rsps.POST, api_url('/oauth2/token/'), json=new_token)
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?offset=0&limit=100&status=credit_pending&ordering=-received_at'),
+                match_querystring=True,
+                json=wrap_response_data(),
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?offset=0&limit=20&resolution=credited&ordering=-received_at'),
+                match_querystring=True,
+                json=wrap_response_data(),
+                status=200,
+            )
+            response = self.client.get(self.url, data={'ordering': '-received_at'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(rsps.calls), 3)
+            self.assertTrue(rsps.calls[0].request.url.endswith('/oauth2/token/'))
+            for call in rsps.calls[1:]:
+                self.assertEqual(call.request.headers['Authorization'], 'Bearer %s' % new_token['access_token'])
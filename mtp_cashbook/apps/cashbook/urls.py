@@ -2,7 +2,7 @@ from django.conf.urls import url
 from django.views.generic import RedirectView
 
 from .views import (
-    NewCreditsView, ProcessingCreditsView,
+    NewCreditsView, ProcessingCreditsView, ProcessingCreditsProgressView,
     ProcessedCreditsListView, ProcessedCreditsDetailView,
     SearchView,
     CashbookFAQView,
@@ -16,6 +16,7 @@ urlpatterns = [
     url(r'^processed/(?P<date>[0-9]{8})-(?P<user_id>[0-9]+)/$',
         ProcessedCreditsDetailView.as_view(), name='processed-credits-detail'),
     url(r'^processing/$', ProcessingCreditsView.as_view(), name='processing-credits'),
+    url(r'^processing/progress/$', ProcessingCreditsProgressView.as_view(), name='processing-credits-progress'),
 
     url(r'^search/$', SearchView.as_view(), name='search'),
     url(r'^all/$', RedirectView.as_view(pattern_name='search', permanent=True)),
@@ -1,24 +1,28 @@
 from datetime import datetime
 import logging
+from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib import messages
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.urls import reverse, reverse_lazy
 from django.utils.translation import gettext_lazy as _
-from django.views.generic import FormView, TemplateView
+from django.views.generic import FormView, TemplateView, View
 from mtp_common.analytics import genericised_pageview
 from mtp_common.auth import api_client
-from mtp_common import nomis
-from requests.exceptions import RequestException
 
 from cashbook.forms import (
     ProcessNewCreditsForm, ProcessManualCreditsForm,
     FilterProcessedCreditsListForm, FilterProcessedCreditsDetailForm,
     SearchForm, MANUALLY_CREDITED_LOG_LEVEL,
 )
+from cashbook.progress import CreditingProgress
 from feedback.views import GetHelpView, GetHelpSuccessView
 from mtp_cashbook.misc_views import BaseView
+from mtp_cashbook.nomis_utils import get_location
+from mtp_cashbook.result_cache import invalidate_cached_results
+from mtp_cashbook.utils import map_concurrently
 
 logger = logging.getLogger('mtp')
 
@@ -73,10 +77,20 @@ class NewCreditsView(CashbookView, FormView):
         """
         if form_class is None:
             form_class = self.get_form_class()
-        return {
+        forms = {
             name: form_class[name](**self.get_form_kwargs())
             for name in form_class
+            if name != 'new'
         }
+        if 'new' in form_class:
+            forms['new'] = form_class['new'](page=self.get_page(), **self.get_form_kwargs())
+        return forms
+
+    def get_page(self):
+        try:
+            return max(1, int(self.request.GET.get('page', 1)))
+        except ValueError:
+            return 1
 
     def get_form_kwargs(self):
         form_kwargs = super().get_form_kwargs()
@@ -90,27 +104,27 @@ class NewCreditsView(CashbookView, FormView):
         batches = session.get('credits/batches/').json()
         if batches['count']:
             last_batch = batches['results'][0]
-            credit_ids = last_batch['credits']
-            incomplete_credits = session.get(
-                'credits/', params={'resolution': 'pending', 'pk': credit_ids}
-            ).json()
-            if not last_batch['expired'] and incomplete_credits['count']:
+            progress = CreditingProgress(request.user.pk)
+            batch_progress = progress.get()
+            if not last_batch['expired'] and not (batch_progress and batch_progress['complete']):
                 return redirect('processing-credits')
 
-            credited_credits = session.get(
-                'credits/', params={'resolution': 'credited', 'pk': credit_ids}
-            ).json()
-            kwargs['credited_credits'] = credited_credits['count']
-            kwargs['failed_credits'] = incomplete_credits['count']
+            if batch_progress:
+                kwargs['credited_credits'] = batch_progress['credited']
+                kwargs['failed_credits'] = batch_progress['total'] - batch_progress['done']
             session.delete(
                 'credits/batches/{batch_id}/'.format(batch_id=last_batch['id'])
             )
+            progress.clear()
+            # the batch's credits have now been credited
+            invalidate_cached_results(request.user)
+        forms = self.get_form()
 
         for message in messages.get_messages(request):
             if message.level == MANUALLY_CREDITED_LOG_LEVEL:
                 kwargs['credited_manual_credits'] = int(message.message)
 
-        return self.render_to_response(self.get_context_data(**kwargs))
+        return self.render_to_response(self.get_context_data(form=forms, **kwargs))
 
     def post(self, request, *args, **kwargs):
         """
@@ -127,47 +141,39 @@ class NewCreditsView(CashbookView, FormView):
             form = forms[form_name]
             if form.is_valid():
                 return self.form_valid(form)
-        return self.form_invalid(None)
+        return self.form_invalid(forms)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['start_page_url'] = settings.START_PAGE_URL
 
-        new_credit_choices = context['form']['new'].credit_choices
-        context['new_object_list'] = new_credit_choices
-        context['total'] = sum([x[1]['amount'] for x in new_credit_choices])
-        context['new_credits'] = len(new_credit_choices)
-
-        manual_credit_choices = context['form']['manual'].credit_choices
-        context['manual_credits'] = len(manual_credit_choices)
-
-        owned_manual_credits = []
-        unowned_manual_credits = []
-        other_owners = set()
-        unowned_oldest_date = None
-        for credit_id, manual_credit in manual_credit_choices:
-            try:
-                location = nomis.get_location(manual_credit['prisoner_number'])
+        new_form = context['form']['new']
+        context['new_object_list'] = new_form.page_credit_choices
+        context['new_credits'] = new_form.summary['count']
+        context['total'] = new_form.summary['amount']
+        context['new_oldest_date'] = new_form.summary['oldest_received_at']
+        context['new_latest_date'] = new_form.summary['latest_received_at']
+
+        manual_form = context['form']['manual']
+        manual_summary = manual_form.summary
+        context['manual_credits'] = manual_summary['count']
+        context['owned_manual_credits'] = len(manual_summary['owned'])
+        context['unowned_manual_credits'] = len(manual_summary['unowned'])
+        context['other_owners'] = manual_summary['other_owners']
+        context['unowned_oldest_date'] = manual_summary['unowned_oldest_date']
+
+        manual_credit_choices = manual_form.credit_choices
+        locations = map_concurrently(
+            lambda manual_credit: get_location(manual_credit['prisoner_number']),
+            (manual_credit for _, manual_credit in manual_credit_choices),
+            max_workers=settings.NOMIS_LOOKUP_WORKERS,
+            timeout=settings.NOMIS_LOOKUP_TIMEOUT,
+        )
+        for (_credit_id, manual_credit), location in zip(manual_credit_choices, locations):
+            if location:
                 manual_credit['new_location'] = location
-            except RequestException:
-                pass
-            if manual_credit['owner'] == self.request.user.pk:
-                owned_manual_credits.append((credit_id, manual_credit))
-            else:
-                unowned_manual_credits.append((credit_id, manual_credit))
-                other_owners.add(manual_credit['owner_name'])
-                if unowned_oldest_date is None or (
-                        manual_credit['set_manual_at'] is not None and
-                        unowned_oldest_date > manual_credit['set_manual_at']):
-                    unowned_oldest_date = manual_credit['set_manual_at']
-
-        context['owned_manual_object_list'] = owned_manual_credits
-        context['owned_manual_credits'] = len(owned_manual_credits)
-
-        context['unowned_manual_object_list'] = unowned_manual_credits
-        context['unowned_manual_credits'] = len(unowned_manual_credits)
-        context['other_owners'] = list(other_owners)
-        context['unowned_oldest_date'] = unowned_oldest_date
+        context['owned_manual_object_list'] = manual_summary['owned']
+        context['unowned_manual_object_list'] = manual_summary['unowned']
 
         if context.get('credited_count', 0):
             username = self.request.user.user_data.get('username', 'Unknown')
@@ -184,6 +190,7 @@ class NewCreditsView(CashbookView, FormView):
         request_params = self.request.GET.dict()
         request_params.setdefault('ordering', '-received_at')
         context['request_params'] = request_params
+        context['page_query_string'] = urlencode({'ordering': request_params['ordering']})
 
         return context
 
@@ -192,7 +199,8 @@ class NewCreditsView(CashbookView, FormView):
         return super().form_valid(form)
 
     def form_invalid(self, form):
-        return self.render_to_response(self.get_context_data())
+        # forms are re-rendered with the credits already loaded to validate them
+        return self.render_to_response(self.get_context_data(form=form))
 
 
 class ProcessingCreditsView(CashbookView, TemplateView):
@@ -201,21 +209,42 @@ class ProcessingCreditsView(CashbookView, TemplateView):
 
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        session = api_client.get_api_session(self.request)
-        batches = session.get('credits/batches/').json()
-        if batches['count'] == 0 or batches['results'][0]['expired']:
+        progress = get_crediting_progress(request)
+        if progress is None:
             return redirect('new-credits')
-        else:
-            credit_ids = batches['results'][0]['credits']
-            total = len(credit_ids)
-            incomplete_credits = session.get(
-                'credits/', params={'resolution': 'pending', 'pk': credit_ids}
-            ).json()
-            done_credit_count = total - incomplete_credits['count']
-            context['percentage'] = int((done_credit_count / total) * 100)
+        context['percentage'] = progress['percentage']
         return self.render_to_response(context)
 
 
+class ProcessingCreditsProgressView(CashbookView, View):
+    """
+    Progress of the user's active batch as JSON for polling
+    """
+
+    def get(self, request, *args, **kwargs):
+        progress = get_crediting_progress(request)
+        return JsonResponse(progress or {
+            'total': 0, 'done': 0, 'percentage': 100, 'complete': True,
+        })
+
+
+def get_crediting_progress(request):
+    """
+    Returns progress of the user's active batch or None if there is no active batch
+    """
+    progress = CreditingProgress(request.user.pk).get()
+    if progress and progress['complete']:
+        return progress
+    # like `NewCreditsView`, an incomplete batch is only over once it expires as failed credits remain pending
+    batches = api_client.get_api_session(request).get('credits/batches/').json()
+    if batches['count'] == 0 or batches['results'][0]['expired']:
+        return None
+    if progress is None:
+        # progress has expired or is being counted on another host
+        progress = CreditingProgress.describe({'total': len(batches['results'][0]['credits'])})
+    return progress
+
+
 class ProcessedCreditsListView(CashbookView, FormView):
     title = _('Processed credits')
     form_class = FilterProcessedCreditsListForm
@@ -276,7 +305,7 @@ class ProcessedCreditsDetailView(ProcessedCreditsListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['total'] = sum(c['amount'] for c in context['object_list'])
+        context['total'] = context['form'].batch_total
         back_url = self.request.build_absolute_uri(str(ProcessedCreditsListView.success_url))
         referer_url = self.request.META.get('HTTP_REFERER') or ''
         if referer_url.startswith(back_url + '?'):
@@ -337,6 +366,7 @@ class SearchView(CashbookView, FormView):
             'credits_returned': form.is_valid() and (new_credit_list or old_credit_list),
             'form_has_errors': not form.is_valid(),
             'object_count': object_count,
+            'new_credits_count': form.pagination.get('new_count', 0),
             'current_page': current_page,
             'page_count': page_count,
             'credit_owner_name': self.request.user.get_full_name(),
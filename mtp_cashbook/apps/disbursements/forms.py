@@ -1,18 +1,17 @@
 import collections
 import datetime
 from decimal import Decimal
+import functools
 import logging
 from math import ceil, floor
 import re
-from urllib.parse import quote_plus, urlencode
+from urllib.parse import urlencode
 
 from django import forms
 from django.conf import settings
 from django.core.validators import RegexValidator
-from django.utils import timezone
 from django.utils.encoding import force_text
 from django.utils.dateformat import format as date_format
-from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.functional import cached_property
 from django.utils.html import format_html, format_html_join
 from django.utils.translation import (
@@ -28,6 +27,10 @@ from mtp_common.auth.exceptions import HttpNotFoundError, Forbidden
 from requests.exceptions import RequestException
 
 from disbursements import metrics
+from disbursements.utils import get_prisoner_location
+from mtp_cashbook.records import Disbursement
+from mtp_cashbook.result_cache import get_cached_results, invalidate_cached_results, prefetch_results
+from mtp_cashbook.utils import DateFieldParser
 
 logger = logging.getLogger('mtp')
 
@@ -108,13 +111,8 @@ class PrisonerForm(DisbursementForm):
         prisoner_number = self.cleaned_data.get('prisoner_number')
         if prisoner_number:
             prisoner_number = prisoner_number.upper()
-            session = get_api_session(self.request)
             try:
-                prisoner = session.get(
-                    '/prisoner_locations/{prisoner_number}/'.format(
-                        prisoner_number=quote_plus(prisoner_number)
-                    )
-                ).json()
+                prisoner = get_prisoner_location(self.request, prisoner_number)
 
                 self.cleaned_data['prisoner_name'] = prisoner['prisoner_name']
                 self.cleaned_data['prisoner_dob'] = prisoner['prisoner_dob']
@@ -420,6 +418,7 @@ class RejectDisbursementForm(GARequestErrorReportingMixin, forms.Form):
             'disbursements/actions/reject/',
             json={'disbursement_ids': [disbursement_id]}
         )
+        invalidate_cached_results(request.user)
         metrics.rejected_counter.inc()
         reason = self.cleaned_data['reason']
         if reason:
@@ -467,6 +466,8 @@ class BaseSearchForm(GARequestErrorReportingMixin, forms.Form):
     page_size = 20
 
     date_fields = ()
+    # when set, results are wrapped in this record type which parses its own date fields when read
+    record_type = None
     exclusive_date_params = ()
 
     filtered_description_template = NotImplemented
@@ -521,29 +522,17 @@ class BaseSearchForm(GARequestErrorReportingMixin, forms.Form):
         """
         MTP API responds with string date/time fields, this filter converts them to python objects
         """
-        parsers = (parse_datetime, parse_date)
-
-        def convert(credit):
-            for field in date_fields:
-                value = credit.get(field)
-                if not value or not isinstance(value, str):
-                    continue
-                for parser in parsers:
-                    try:
-                        value = parser(value)
-                        if isinstance(value, datetime.datetime):
-                            value = timezone.localtime(value)
-                        credit[field] = value
-                        break
-                    except (ValueError, TypeError):
-                        pass
-            return credit
-
-        return list(map(convert, object_list)) if object_list else object_list
+        return DateFieldParser(date_fields).parse(object_list) if object_list else object_list
 
     def get_object_list_endpoint_path(self):
         raise NotImplementedError
 
+    def retrieve_object_list(self, page, filters, session=None):
+        return (session or self.session).get(
+            self.get_object_list_endpoint_path(),
+            params=dict(offset=(page - 1) * self.page_size, limit=self.page_size, **filters)
+        ).json()
+
     def get_object_list(self):
         """
         Gets the object list
@@ -552,20 +541,27 @@ class BaseSearchForm(GARequestErrorReportingMixin, forms.Form):
         page = self.cleaned_data.get('page')
         if not page:
             return []
-        offset = (page - 1) * self.page_size
         filters = self.get_api_request_params()
-        try:
-            data = self.session.get(
-                self.get_object_list_endpoint_path(),
-                params=dict(offset=offset, limit=self.page_size, **filters)
-            ).json()
-        except RequestException:
-            logger.exception('Error loading disbursements')
-            self.add_error(None, _('This service is currently unavailable'))
-            return []
+        path = self.get_object_list_endpoint_path()
+        # only pages loaded by `prefetch_results` are cached
+        data = get_cached_results(self.request.user, path, filters, page)
+        if data is None:
+            try:
+                data = self.retrieve_object_list(page, filters)
+            except RequestException:
+                logger.exception('Error loading disbursements')
+                self.add_error(None, _('This service is currently unavailable'))
+                return []
         count = data.get('count', 0)
         self.total_count = count
         self.page_count = int(ceil(count / self.page_size))
+        if page < self.page_count:
+            prefetch_results(
+                self.request, path, filters, page + 1,
+                functools.partial(self.retrieve_object_list, page + 1, filters),
+            )
+        if self.record_type:
+            return list(map(self.record_type, data.get('results', [])))
         return self.parse_date_fields(data.get('results', []), self.date_fields)
 
     @cached_property
@@ -700,7 +696,7 @@ class SearchForm(BaseSearchForm):
 
     # form config
     page_size = 10
-    date_fields = ('created',)
+    record_type = Disbursement
     exclusive_date_params = ('date__lt',)
 
     # search descriptions
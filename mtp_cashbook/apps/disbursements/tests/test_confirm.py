@@ -1,12 +1,15 @@
 from functools import partial
 from unittest import mock
 
+from django.core.cache import cache
+from django.test import override_settings
 from django.urls import reverse
 from mtp_common.test_utils import silence_logger
 from requests.exceptions import HTTPError
 import responses
 
 from cashbook.tests import MTPBaseTestCase, api_url
+from mtp_cashbook.nomis_utils import get_location_cache_key, get_nomis_session
 
 
 SAMPLE_DISBURSEMENTS = [
@@ -319,8 +322,8 @@ def mock_pending_list(func):
             )
 
     @responses.activate
-    @mock.patch('disbursements.utils.nomis.get_location')
-    @mock.patch('disbursements.utils.nomis.get_account_balances')
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_location')
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_account_balances')
     def wrapper(self, mock_nomis_get_account_balances, mock_nomis_get_location, *args, **kwargs):
         func(
             self,
@@ -343,8 +346,8 @@ def mock_pending_detail(func):
         mock_nomis_responses_for_disbursement(mock_nomis_get_account_balances, mock_nomis_get_location, disbursement)
 
     @responses.activate
-    @mock.patch('disbursements.utils.nomis.get_location')
-    @mock.patch('disbursements.utils.nomis.get_account_balances')
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_location')
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_account_balances')
     def wrapper(self, mock_nomis_get_account_balances, mock_nomis_get_location, *args, **kwargs):
         func(
             self,
@@ -402,6 +405,37 @@ class PendingListDisbursementTestCase(PendingDisbursementTestCase):
 
         self.assertContains(response, 'Insufficient funds')
 
+    @responses.activate
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_location')
+    @mock.patch('mtp_cashbook.nomis_utils.nomis.get_account_balances')
+    def test_pending_list_looks_up_each_prisoner_once(self, mock_nomis_get_account_balances, mock_nomis_get_location):
+        self.login(credentials={'username': 'test-hmp-brixton-a', 'password': 'pass'})
+        disbursements = [
+            SAMPLE_DISBURSEMENTS[3],
+            dict(SAMPLE_DISBURSEMENTS[3], id=655),
+            SAMPLE_DISBURSEMENTS[4],
+        ]
+        for resolution, results in (('pending', disbursements), ('preconfirmed', [])):
+            responses.add(
+                responses.GET,
+                api_url(f'/disbursements/?resolution={resolution}&offset=0&limit=100'),
+                match_querystring=True,
+                json={'count': len(results), 'results': results},
+                status=200
+            )
+        mock_nomis_responses_for_disbursement(
+            mock_nomis_get_account_balances, mock_nomis_get_location, SAMPLE_DISBURSEMENTS[3],
+        )
+
+        response = self.client.get(self.url)
+        self.assertOnPage(response, 'disbursements:pending_list')
+        self.assertEqual(mock_nomis_get_account_balances.call_count, 2)
+        self.assertEqual(mock_nomis_get_location.call_count, 2)
+        self.assertSetEqual(
+            {call[0][0] for call in mock_nomis_get_location.call_args_list},
+            {SAMPLE_DISBURSEMENTS[3]['prisoner_number'], SAMPLE_DISBURSEMENTS[4]['prisoner_number']},
+        )
+
 
 class PendingDetailDisbursementTestCase(PendingDisbursementTestCase):
 
@@ -436,6 +470,21 @@ class PendingDetailDisbursementTestCase(PendingDisbursementTestCase):
             html=True
         )
 
+    @override_settings(SHARED_CACHE=True)
+    @mock_pending_detail
+    def test_prisoner_moved_invalidates_cached_location(self, calls_mocker):
+        self.login(credentials={'username': 'test-hmp-brixton-a', 'password': 'pass'})
+        disbursement = SAMPLE_DISBURSEMENTS[1]
+        calls_mocker(disbursement)
+
+        response = self.client.get(self.url(disbursement['id']))
+        self.assertOnPage(response, 'disbursements:pending_detail')
+        self.assertIsNotNone(cache.get(get_location_cache_key(disbursement['prisoner_number'])))
+
+        response = self.client.post(self.url(disbursement['id']), data={'confirmation': 'yes'})
+        self.assertOnPage(response, 'disbursements:pending_detail')
+        self.assertIsNone(cache.get(get_location_cache_key(disbursement['prisoner_number'])))
+
 
 class UpdatePendingDisbursementTestCase(PendingDisbursementTestCase):
 
@@ -939,6 +988,7 @@ class ConfirmPendingDisbursementTestCase(PendingDisbursementTestCase):
             description='Sent to Katy Hicks',
             transaction_type='RELA',
             retries=1,
+            session=get_nomis_session(),
         )
 
     @mock_pending_detail
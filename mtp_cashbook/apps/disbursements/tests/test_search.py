@@ -1,5 +1,7 @@
 import datetime
-from django.test import SimpleTestCase
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from django.utils.html import strip_tags
 import responses
@@ -110,6 +112,39 @@ class DisbursementSearchViewTextCase(MTPBaseTestCase):
         self.assertIn('email@local', content)
         self.assertIn('Page 2 of 2', content)
 
+    @override_settings(RESULT_CACHE_TTL=30, RESULT_PREFETCH=True)
+    @mock.patch('mtp_cashbook.result_cache.get_prefetch_executor', return_value=mock.Mock(submit=lambda func: func()))
+    def test_next_page_is_prefetched(self, _):
+        self.login()
+        disbursement = {
+            'id': 99, 'amount': 25010, 'invoice_number': '1000099',
+            'method': 'cheque', 'resolution': 'confirmed', 'nomis_transaction_id': None,
+            'prisoner_name': 'JOHN HALLS', 'prisoner_number': 'A1409AE',
+            'recipient_first_name': 'FN', 'recipient_last_name': 'SN', 'recipient_email': '',
+            'address_line1': '102 Petty France', 'address_line2': '',
+            'city': 'London', 'postcode': 'SW1H 9AJ', 'country': 'UK',
+            'sort_code': '', 'account_number': '', 'roll_number': '',
+            'log_set': [{'action': 'confirmed', 'created': '2018-01-10T09:00:00Z', 'user': self.user}],
+        }
+        with responses.RequestsMock() as rsps:
+            for _ in range(2):
+                rsps.add(rsps.GET, api_url('/disbursements/?resolution=pending&limit=1',),
+                         json={'count': 0, 'results': []}, match_querystring=True)
+            rsps.add(rsps.GET, api_url('/disbursements/?offset=0&limit=10&ordering=-created&resolution=confirmed',),
+                     match_querystring=True,
+                     json={'count': 11, 'results': [dict(disbursement, id=100, prisoner_name='JILLY HALL')]})
+            rsps.add(rsps.GET, api_url('/disbursements/?offset=10&limit=10&ordering=-created&resolution=confirmed',),
+                     match_querystring=True,
+                     json={'count': 11, 'results': [disbursement]})
+            response = self.client.get(self.url + '?page=1&resolution=confirmed')
+            self.assertContains(response, 'JILLY HALL')
+            self.assertEqual(len(rsps.calls), 3)
+
+            response = self.client.get(self.url + '?page=2&resolution=confirmed')
+            self.assertContains(response, 'JOHN HALLS')
+            self.assertContains(response, 'Page 2 of 2')
+            self.assertEqual(len(rsps.calls), 4)
+
 
 class DisbursementSearchFormTextCase(SimpleTestCase):
     def test_blank_form_valid(self):
@@ -1,37 +1,80 @@
+from functools import partial
+
+from urllib.parse import quote_plus
+
 from django.conf import settings
-from mtp_common import nomis
+from django.core.cache import cache
+from mtp_common.auth.api_client import get_api_session
 import requests
 from requests.exceptions import RequestException
 
+from mtp_cashbook import metrics
+from mtp_cashbook.nomis_utils import get_account_balances, get_location, invalidate_location
+from mtp_cashbook.utils import map_concurrently
+
 
 def get_disbursement_viability(request, disbursement):
-    viability = {}
-    nomis_session = requests.Session()
-    try:
-        accounts = nomis.get_account_balances(
-            disbursement['prison'],
-            disbursement['prisoner_number'],
-            session=nomis_session
+    return get_disbursement_viabilities(request, [disbursement])[0]
+
+
+def get_disbursement_viabilities(request, disbursements):
+    """
+    Checks the viability of several disbursements at once:
+    NOMIS balances and locations are looked up concurrently and only once per prisoner
+    """
+    balance_keys = sorted(set(
+        (disbursement['prison'], disbursement['prisoner_number'])
+        for disbursement in disbursements
+    ))
+    prisoner_numbers = sorted(set(
+        disbursement['prisoner_number']
+        for disbursement in disbursements
+    ))
+    lookups = [
+        partial(get_account_balances, prison, prisoner_number, request=request)
+        for prison, prisoner_number in balance_keys
+    ] + [
+        partial(get_location, prisoner_number)
+        for prisoner_number in prisoner_numbers
+    ]
+    results = map_concurrently(
+        lambda lookup: lookup(),
+        lookups,
+        max_workers=settings.NOMIS_LOOKUP_WORKERS,
+        timeout=settings.NOMIS_LOOKUP_TIMEOUT,
+    )
+    balances = dict(zip(balance_keys, results[:len(balance_keys)]))
+    locations = dict(zip(prisoner_numbers, results[len(balance_keys):]))
+
+    return [
+        evaluate_disbursement_viability(
+            request, disbursement,
+            balances[(disbursement['prison'], disbursement['prisoner_number'])],
+            locations[disbursement['prisoner_number']],
         )
+        for disbursement in disbursements
+    ]
+
 
+def evaluate_disbursement_viability(request, disbursement, accounts, location):
+    """
+    Works out the viability of a disbursement given the prisoner's NOMIS balances and location,
+    either of which can be None if they could not be looked up
+    """
+    viability = {}
+    if accounts is not None:
         viability['insufficient_funds'] = (
             disbursement['amount'] > accounts['cash']
         )
-    except RequestException:
-        pass
-
-    try:
-        location = nomis.get_location(disbursement['prisoner_number'])
 
+    if location is not None:
         viability['prisoner_moved'] = (
             disbursement['prison'] != location['nomis_id']
         )
-    except RequestException:
-        pass
 
     change_logs = sorted(
-        filter(lambda l: l['action'] in ('created', 'edited'), disbursement['log_set']),
-        key=lambda l: l['created']
+        filter(lambda log: log['action'] in ('created', 'edited'), disbursement['log_set']),
+        key=lambda log: log['created']
     )
     viability['self_own'] = (
         change_logs and change_logs[-1]['user']['username'] == request.user.username
@@ -52,6 +95,39 @@ def get_disbursement_viability(request, disbursement):
     return viability
 
 
+def get_prisoner_location_cache_key(request, prisoner_number):
+    # the api only returns prisoners in the user's prisons so the cached response is specific to them
+    prisons = ','.join(sorted(prison['nomis_id'] for prison in request.user.user_data.get('prisons') or []))
+    return 'prisoner-location-%s-%s' % (prisoner_number, prisons)
+
+
+def get_prisoner_location(request, prisoner_number):
+    """
+    Looks up a prisoner's location using the api, caching it for NOMIS_LOCATION_CACHE_TTL seconds
+    if the cache is shared so that any process can invalidate it
+    """
+    cache_key = get_prisoner_location_cache_key(request, prisoner_number)
+    if settings.SHARED_CACHE:
+        prisoner = cache.get(cache_key)
+        if prisoner is not None:
+            metrics.location_cache_hit_counter.inc()
+            return prisoner
+        metrics.location_cache_miss_counter.inc()
+    prisoner = get_api_session(request).get(
+        '/prisoner_locations/{prisoner_number}/'.format(
+            prisoner_number=quote_plus(prisoner_number)
+        )
+    ).json()
+    if settings.SHARED_CACHE:
+        cache.set(cache_key, prisoner, timeout=settings.NOMIS_LOCATION_CACHE_TTL)
+    return prisoner
+
+
+def invalidate_prisoner_location(request, prisoner_number):
+    invalidate_location(prisoner_number)
+    cache.delete(get_prisoner_location_cache_key(request, prisoner_number))
+
+
 def find_addresses(postcode):
     try:
         results = requests.get(
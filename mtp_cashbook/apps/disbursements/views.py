@@ -17,9 +17,16 @@ from requests.exceptions import HTTPError, RequestException
 
 from cashbook.templatetags.currency import currency
 from disbursements import forms as disbursement_forms, metrics
-from disbursements.utils import get_disbursement_viability, find_addresses
+from disbursements.utils import (
+    get_disbursement_viability, get_disbursement_viabilities, invalidate_prisoner_location, find_addresses,
+)
 from feedback.views import GetHelpView, GetHelpSuccessView
 from mtp_cashbook.misc_views import BaseView
+from mtp_cashbook.nomis_utils import (
+    call_nomis, get_account_balances, get_nomis_session, invalidate_account_balances,
+)
+from mtp_cashbook.records import Disbursement
+from mtp_cashbook.result_cache import invalidate_cached_results
 
 logger = logging.getLogger('mtp')
 
@@ -210,7 +217,7 @@ class AmountView(BasePagedFormView):
     def get_nomis_balances(self):
         try:
             form_data = self.get_valid_form_data(PrisonerView)
-            return nomis.get_account_balances(form_data['prison'], form_data['prisoner_number'])
+            return get_account_balances(form_data['prison'], form_data['prisoner_number'], request=self.request)
         except (RequestException, KeyError):
             pass
 
@@ -389,6 +396,7 @@ class CreatedView(BasePagedView):
         try:
             self.api_session.post('/disbursements/', json=disbursement_data)
             metrics.entered_counter.inc()
+            invalidate_cached_results(request.user)
         except RequestException:
             logger.exception('Failed to create disbursement')
             return redirect('%s?e=connection' % self.previous_view.url())
@@ -408,18 +416,17 @@ class PendingListView(DisbursementView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['disbursements'] = retrieve_all_pages_for_path(
+        context['disbursements'] = list(map(Disbursement, retrieve_all_pages_for_path(
             self.api_session, 'disbursements/', resolution='pending'
-        )
-        context['disbursements'] += retrieve_all_pages_for_path(
+        )))
+        context['disbursements'] += map(Disbursement, retrieve_all_pages_for_path(
             self.api_session, 'disbursements/', resolution='preconfirmed'
-        )
+        ))
         context['pending_count'] = len(context['disbursements'])
 
-        for disbursement in context['disbursements']:
-            disbursement.update(
-                **get_disbursement_viability(self.request, disbursement)
-            )
+        viabilities = get_disbursement_viabilities(self.request, context['disbursements'])
+        for disbursement, viability in zip(context['disbursements'], viabilities):
+            disbursement.update(**viability)
 
         return context
 
@@ -443,9 +450,9 @@ class PendingDetailView(BaseConfirmationView):
 
     def dispatch(self, request, **kwargs):
         try:
-            self.disbursement = self.api_session.get(
+            self.disbursement = Disbursement(self.api_session.get(
                 'disbursements/{pk}/'.format(pk=kwargs['pk'])
-            ).json()
+            ).json())
         except HttpNotFoundError:
             raise Http404('Disbursement %s not found' % kwargs['pk'])
         self.disbursement_viability = get_disbursement_viability(self.request, self.disbursement)
@@ -473,7 +480,8 @@ class PendingDetailView(BaseConfirmationView):
     def create_nomis_transaction(self, form):
         disbursement = self.disbursement
         try:
-            nomis_response = nomis.create_transaction(
+            nomis_response = call_nomis(
+                nomis.create_transaction,
                 prison_id=disbursement['prison'],
                 prisoner_number=disbursement['prisoner_number'],
                 amount=disbursement['amount'],
@@ -483,7 +491,8 @@ class PendingDetailView(BaseConfirmationView):
                     recipient_last_name=disbursement['recipient_last_name'],
                 ).replace('  ', ' '),
                 transaction_type='RELA',
-                retries=1
+                retries=1,
+                session=get_nomis_session(),
             )
             return nomis_response['id']
         except HTTPError as e:
@@ -500,6 +509,8 @@ class PendingDetailView(BaseConfirmationView):
                 form.add_error(None, self.error_messages['connection'])
             else:
                 logger.warning('Disbursement %s is invalid' % disbursement['id'])
+                # the prisoner may have moved since their location was cached
+                invalidate_prisoner_location(self.request, disbursement['prisoner_number'])
                 form.add_error(None, self.error_messages['invalid'])
         except RequestException:
             logger.exception(
@@ -507,6 +518,8 @@ class PendingDetailView(BaseConfirmationView):
                 % disbursement['id']
             )
             form.add_error(None, self.error_messages['connection'])
+        finally:
+            invalidate_account_balances(disbursement['prison'], disbursement['prisoner_number'], request=self.request)
 
     def form_valid(self, form):
         if form.cleaned_data['confirmation'] == 'no':
@@ -516,6 +529,8 @@ class PendingDetailView(BaseConfirmationView):
             return self.form_invalid(form)
 
         if not self.disbursement_viability['viable']:
+            if self.disbursement_viability.get('prisoner_moved'):
+                invalidate_prisoner_location(self.request, self.disbursement['prisoner_number'])
             form.add_error(None, self.error_messages['invalid'])
             return self.form_invalid(form)
 
@@ -544,6 +559,7 @@ class PendingDetailView(BaseConfirmationView):
                 'disbursements/actions/confirm/',
                 json=[update]
             )
+            invalidate_cached_results(self.request.user)
             metrics.confirmed_counter.inc()
             return redirect(ConfirmedView.url() + url_suffix)
 
@@ -632,6 +648,7 @@ class BaseEditFormView(BasePagedFormView):
                 'disbursements/{pk}/'.format(**self.kwargs),
                 json=update
             )
+            invalidate_cached_results(self.request.user)
         return super().form_valid(form)
 
     def get_update_payload(self, form):
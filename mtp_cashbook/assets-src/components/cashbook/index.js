@@ -1,6 +1,7 @@
 'use strict';
 
 import {BatchValidation} from './batch-validation';
+import {ProcessingProgress} from './processing-progress';
 import {SelectAll} from './select-all';
 import {StickyHeader} from './sticky-header';
 
@@ -9,7 +10,9 @@ export var Cashbook = {
     SelectAll.init();
     StickyHeader.init();
     BatchValidation.init();
+    ProcessingProgress.init();
     this.initSelectionCount();
+    this.initSelectAllPages();
     this.initConfirmManual();
   },
 
@@ -17,13 +20,24 @@ export var Cashbook = {
     // displays a running count of selected credits
     $('.mtp-input--selection-count').each(function () {
       var $countContainer = $(this);
-      $('.mtp-input--counted').on('change', function () {
-        var itemCount = $('.mtp-input--counted:checked').length;
+      $('.mtp-input--counted, .mtp-checkboxes--select-all-pages').on('change', function () {
+        // when credits on all pages are selected, the count includes those not shown
+        var itemCount = $('.mtp-checkboxes--select-all-pages:checked').data('count') ||
+          $('.mtp-input--counted:checked').length;
         displayCreditSelectionCount(itemCount, $countContainer);
       });
     });
   },
 
+  initSelectAllPages: function () {
+    // selecting credits on all pages also selects all those shown
+    $('.mtp-checkboxes--select-all-pages').on('change', function () {
+      if (this.checked) {
+        $('.mtp-checkboxes--select-all').first().prop('checked', true).change();
+      }
+    });
+  },
+
   initConfirmManual: function () {
     // display a dialogue box to ask for confirmation before submitting manual credit form
     $('.mtp-form--confirm-manual').on('click', ':submit', function (e) {
@@ -0,0 +1,44 @@
+// Crediting progress module
+'use strict';
+
+export var ProcessingProgress = {
+  selector: '.mtp-progress-bar[data-progress-url]',
+
+  init: function () {
+    this.$progressBar = $(this.selector);
+    if (this.$progressBar.length === 0) {
+      return;
+    }
+    this.url = this.$progressBar.data('progress-url');
+    this.schedulePoll();
+  },
+
+  pollInterval: 2000,
+
+  schedulePoll: function () {
+    setTimeout($.proxy(this.poll, this), this.pollInterval);
+  },
+
+  // checks progress periodically and reloads the page once crediting is complete
+  poll: function () {
+    $.ajax({
+      url: this.url,
+      dataType: 'json',
+      cache: false
+    }).done($.proxy(this.update, this)).fail(function () {
+      setTimeout(function () {
+        window.location.reload();
+      }, 5000);
+    });
+  },
+
+  update: function (progress) {
+    if (progress.complete) {
+      window.location.reload();
+      return;
+    }
+    this.$progressBar.find('.mtp-progress-bar__fill').css('width', progress.percentage + '%');
+    this.$progressBar.find('.mtp-progress-bar__percentage').text(progress.percentage + '%');
+    this.schedulePoll();
+  }
+};
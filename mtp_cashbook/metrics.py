@@ -0,0 +1,39 @@
+from django.apps import apps
+from prometheus_client import Counter, Gauge
+
+nomis_pool_hit_counter = Counter(
+    'mtp_cashbook_nomis_pool_hits', 'NOMIS requests that reused a pooled connection'
+)
+nomis_pool_miss_counter = Counter(
+    'mtp_cashbook_nomis_pool_misses', 'NOMIS requests that needed a new connection'
+)
+
+location_cache_hit_counter = Counter(
+    'mtp_cashbook_location_cache_hits', 'Prisoner location lookups answered from cache'
+)
+location_cache_miss_counter = Counter(
+    'mtp_cashbook_location_cache_misses', 'Prisoner location lookups not found in cache'
+)
+
+nomis_circuit_state_gauge = Gauge(
+    'mtp_cashbook_nomis_circuit_state', 'NOMIS circuit breaker state: 0 closed, 1 half-open, 2 open'
+)
+nomis_circuit_rejected_counter = Counter(
+    'mtp_cashbook_nomis_circuit_rejected', 'NOMIS calls not made because the circuit breaker was open'
+)
+nomis_concurrency_limit_gauge = Gauge(
+    'mtp_cashbook_nomis_concurrency_limit', 'Current adaptive limit on concurrent NOMIS calls'
+)
+nomis_in_flight_gauge = Gauge(
+    'mtp_cashbook_nomis_in_flight', 'NOMIS calls currently being made'
+)
+
+app = apps.get_app_config('metrics')
+app.register_collector(nomis_pool_hit_counter)
+app.register_collector(nomis_pool_miss_counter)
+app.register_collector(location_cache_hit_counter)
+app.register_collector(location_cache_miss_counter)
+app.register_collector(nomis_circuit_state_gauge)
+app.register_collector(nomis_circuit_rejected_counter)
+app.register_collector(nomis_concurrency_limit_gauge)
+app.register_collector(nomis_in_flight_gauge)
@@ -1,4 +1,5 @@
 from mtp_cashbook import READ_ML_BRIEFING_FLAG
+from mtp_cashbook.result_cache import start_prefetches
 
 
 class CashbookMiddleware:
@@ -8,7 +9,7 @@ class CashbookMiddleware:
     def __call__(self, request):
         request.read_ml_briefing = self.read_ml_briefing(request)
         request.pre_approval_required = self.pre_approval_required(request)
-        return self.get_response(request)
+        return start_prefetches(request, self.get_response(request))
 
     def read_ml_briefing(self, request):
         return (
@@ -0,0 +1,303 @@
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from mtp_common import nomis
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from mtp_cashbook import metrics
+
+logger = logging.getLogger('mtp')
+
+
+class CountingConnectionPoolMixin:
+    """
+    Records whether connections taken from the pool are reused or need to be (re)established
+    """
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        if getattr(conn, 'sock', None) is None:
+            metrics.nomis_pool_miss_counter.inc()
+        else:
+            metrics.nomis_pool_hit_counter.inc()
+        return conn
+
+
+class CountingHTTPConnectionPool(CountingConnectionPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingConnectionPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class NomisHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+class NomisSessionPool:
+    """
+    Process-wide HTTP session for Prison API (i.e. NOMIS) calls so that connections are kept alive
+    and shared between threads. The session is only created when first needed so that forked
+    uWSGI workers do not share sockets; it is never closed as other threads may be using it
+    and urllib3 already discards connections that were dropped while idle.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = NomisHTTPAdapter(pool_maxsize=settings.NOMIS_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                self.session = self.create_session()
+            return self.session
+
+
+nomis_session_pool = NomisSessionPool()
+
+
+def get_nomis_session():
+    return nomis_session_pool.get_session()
+
+
+class NomisUnavailable(RequestException):
+    """
+    Raised instead of calling NOMIS while the circuit breaker is open
+    or when too many calls are already in progress
+    """
+
+
+class NomisCircuitBreaker:
+    """
+    Process-wide circuit breaker for NOMIS calls: once at least NOMIS_CIRCUIT_MIN_CALLS calls were made
+    in the last NOMIS_CIRCUIT_WINDOW seconds and NOMIS_CIRCUIT_FAILURE_RATE of them failed or were slow,
+    calls are rejected for NOMIS_CIRCUIT_BACKOFF seconds. One trial call is then let through (half-open):
+    if it succeeds, the circuit closes, otherwise it opens again for twice as long up to NOMIS_CIRCUIT_MAX_BACKOFF
+    """
+    closed, half_open, open = 0, 1, 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.outcomes = collections.deque()
+        self.failures = 0
+        self.backoff = None
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.set_state(self.closed)
+
+    def set_state(self, state):
+        self.state = state
+        metrics.nomis_circuit_state_gauge.set(state)
+
+    def before_call(self):
+        """
+        Raises NomisUnavailable if the call should not be made;
+        returns whether the call is the half-open trial and must be followed by `after_call`
+        """
+        with self.lock:
+            if self.state == self.open:
+                if time.monotonic() - self.opened_at < self.backoff:
+                    metrics.nomis_circuit_rejected_counter.inc()
+                    raise NomisUnavailable('NOMIS circuit breaker is open')
+                self.set_state(self.half_open)
+            if self.state == self.half_open:
+                if self.trial_in_progress:
+                    metrics.nomis_circuit_rejected_counter.inc()
+                    raise NomisUnavailable('NOMIS circuit breaker is half-open')
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def after_call(self, failed, trial):
+        with self.lock:
+            now = time.monotonic()
+            if trial:
+                self.trial_in_progress = False
+                if failed:
+                    self.trip(now, self.backoff * 2)
+                else:
+                    self.outcomes.clear()
+                    self.failures = 0
+                    self.backoff = None
+                    self.set_state(self.closed)
+                    logger.info('NOMIS circuit breaker closed')
+                return
+            if self.state != self.closed:
+                # calls started before the circuit opened
+                return
+
+            self.outcomes.append((now, failed))
+            self.failures += failed
+            window_start = now - settings.NOMIS_CIRCUIT_WINDOW
+            while self.outcomes and self.outcomes[0][0] < window_start:
+                self.failures -= self.outcomes.popleft()[1]
+            calls = len(self.outcomes)
+            if calls >= settings.NOMIS_CIRCUIT_MIN_CALLS and \
+                    self.failures / calls >= settings.NOMIS_CIRCUIT_FAILURE_RATE:
+                self.trip(now, settings.NOMIS_CIRCUIT_BACKOFF)
+
+    def trip(self, now, backoff):
+        self.backoff = min(backoff, settings.NOMIS_CIRCUIT_MAX_BACKOFF)
+        self.opened_at = now
+        self.outcomes.clear()
+        self.failures = 0
+        self.set_state(self.open)
+        logger.error('NOMIS circuit breaker opened for %s seconds' % self.backoff)
+
+
+class NomisConcurrencyLimiter:
+    """
+    Adaptive limit on concurrent NOMIS calls per process: it starts at NOMIS_CONCURRENCY_LIMIT,
+    halves after a failed or slow call and grows back by one after a limit's worth of successful calls;
+    calls wait up to NOMIS_CONCURRENCY_WAIT seconds to start
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.in_flight = 0
+        self.limit = None
+        metrics.nomis_in_flight_gauge.set(0)
+
+    def acquire(self):
+        with self.condition:
+            if self.limit is None:
+                self.limit = float(max(1, settings.NOMIS_CONCURRENCY_LIMIT))
+                metrics.nomis_concurrency_limit_gauge.set(self.limit)
+            if not self.condition.wait_for(lambda: self.in_flight < int(self.limit),
+                                           timeout=settings.NOMIS_CONCURRENCY_WAIT):
+                raise NomisUnavailable('Too many NOMIS calls in progress')
+            self.in_flight += 1
+            metrics.nomis_in_flight_gauge.set(self.in_flight)
+
+    def release(self, failed):
+        with self.condition:
+            self.in_flight -= 1
+            if failed:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(max(1, settings.NOMIS_CONCURRENCY_LIMIT)), self.limit + 1 / self.limit)
+            metrics.nomis_in_flight_gauge.set(self.in_flight)
+            metrics.nomis_concurrency_limit_gauge.set(self.limit)
+            self.condition.notify_all()
+
+
+nomis_circuit_breaker = NomisCircuitBreaker()
+nomis_concurrency_limiter = NomisConcurrencyLimiter()
+
+
+def call_nomis(func, *args, **kwargs):
+    """
+    Calls a `mtp_common.nomis` function through the process-wide circuit breaker and concurrency limiter;
+    any error other than a 4xx response and calls slower than NOMIS_CIRCUIT_SLOW_CALL seconds count as failures
+    """
+    trial = nomis_circuit_breaker.before_call()
+    try:
+        nomis_concurrency_limiter.acquire()
+    except NomisUnavailable:
+        if trial:
+            # the trial call could not be made so the circuit opens again
+            nomis_circuit_breaker.after_call(True, trial)
+        raise
+    failed = True
+    start = time.monotonic()
+    try:
+        result = func(*args, **kwargs)
+        failed = False
+        return result
+    except HTTPError as e:
+        failed = e.response is None or e.response.status_code >= 500
+        raise
+    finally:
+        failed = failed or time.monotonic() - start > settings.NOMIS_CIRCUIT_SLOW_CALL
+        nomis_concurrency_limiter.release(failed)
+        nomis_circuit_breaker.after_call(failed, trial)
+
+
+def get_location_cache_key(prisoner_number):
+    return 'nomis-location-%s' % prisoner_number
+
+
+def get_location(prisoner_number):
+    """
+    Looks up a prisoner's NOMIS location, caching it for NOMIS_LOCATION_CACHE_TTL seconds
+    if the cache is shared so that crediting tasks can invalidate it
+    """
+    if not settings.SHARED_CACHE:
+        return call_nomis(nomis.get_location, prisoner_number, session=get_nomis_session())
+    cache_key = get_location_cache_key(prisoner_number)
+    location = cache.get(cache_key)
+    if location is not None:
+        metrics.location_cache_hit_counter.inc()
+        return location
+    metrics.location_cache_miss_counter.inc()
+    location = call_nomis(nomis.get_location, prisoner_number, session=get_nomis_session())
+    cache.set(cache_key, location, timeout=settings.NOMIS_LOCATION_CACHE_TTL)
+    return location
+
+
+def invalidate_location(prisoner_number):
+    cache.delete(get_location_cache_key(prisoner_number))
+
+
+def get_account_balances_cache_key(prison, prisoner_number):
+    return 'nomis-balances-%s-%s' % (prison, prisoner_number)
+
+
+def get_account_balances(prison, prisoner_number, request=None):
+    """
+    Looks up a prisoner's NOMIS account balances and, if a request is provided, reuses the same snapshot
+    for the rest of that request. Snapshots are only cached between requests, for NOMIS_BALANCES_CACHE_TTL seconds,
+    if the cache is shared so that invalidating them after a NOMIS transaction reaches every process
+    """
+    request_balances = None
+    if request is not None:
+        if not hasattr(request, 'nomis_balances'):
+            request.nomis_balances = {}
+        request_balances = request.nomis_balances
+        if (prison, prisoner_number) in request_balances:
+            return request_balances[(prison, prisoner_number)]
+
+    cache_key = get_account_balances_cache_key(prison, prisoner_number)
+    balances = cache.get(cache_key) if settings.SHARED_CACHE else None
+    if balances is None:
+        balances = call_nomis(nomis.get_account_balances, prison, prisoner_number, session=get_nomis_session())
+        if settings.SHARED_CACHE:
+            cache.set(cache_key, balances, timeout=settings.NOMIS_BALANCES_CACHE_TTL)
+    if request_balances is not None:
+        request_balances[(prison, prisoner_number)] = balances
+    return balances
+
+
+def invalidate_account_balances(prison, prisoner_number, request=None):
+    """
+    Call after anything that could change a prisoner's balances, such as creating a NOMIS transaction
+    """
+    cache.delete(get_account_balances_cache_key(prison, prisoner_number))
+    if request is not None and hasattr(request, 'nomis_balances'):
+        request.nomis_balances.pop((prison, prisoner_number), None)
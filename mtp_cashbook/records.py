@@ -0,0 +1,180 @@
+import datetime
+
+from django.utils import timezone
+
+from mtp_cashbook.utils import parse_date_value
+
+
+class DateField:
+    """
+    Record attribute holding an MTP API date/time string that is only parsed when first read
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.slot = '_%s' % name
+
+    def __get__(self, record, owner=None):
+        if record is None:
+            return self
+        value = getattr(record, self.slot)
+        if value and isinstance(value, str):
+            try:
+                parsed_value = parse_date_value(value)
+                if isinstance(parsed_value, datetime.datetime):
+                    parsed_value = timezone.localtime(parsed_value)
+            except (ValueError, TypeError):
+                # unparseable and naive values are left unchanged
+                parsed_value = None
+            if parsed_value:
+                value = parsed_value
+                setattr(record, self.slot, value)
+        return value
+
+    def __set__(self, record, value):
+        setattr(record, self.slot, value)
+
+
+class RecordMeta(type):
+    """
+    Turns a record's `fields` into slots so that instances carry no per-instance dict;
+    `date_fields` are stored as strings until first read
+    """
+
+    def __new__(cls, name, bases, namespace):
+        fields = tuple(namespace.get('fields', ()))
+        date_fields = tuple(namespace.get('date_fields', ()))
+        slots = list(namespace.get('__slots__', ()))
+        for field in fields:
+            if field in date_fields:
+                namespace[field] = DateField(field)
+                slots.append('_%s' % field)
+            else:
+                slots.append(field)
+        namespace['__slots__'] = tuple(slots)
+        record_type = super().__new__(cls, name, bases, namespace)
+        record_type.field_set = frozenset(fields)
+        return record_type
+
+
+class Record(metaclass=RecordMeta):
+    """
+    Compact, mutable replacement for an MTP API object's dict:
+    known `fields` are stored in slots and any other keys the api returns are kept in a dict only when present.
+    Values can be read as attributes or with dict-style access so existing code and templates work unchanged;
+    with dict-style access, fields that were never set are missing like a dict's keys but read as None as attributes
+    """
+    __slots__ = ('_extra',)
+    fields = ()
+    date_fields = ()
+    # records are mutable like the dicts they replace so cannot be hashed
+    __hash__ = None
+
+    def __init__(self, data=(), **kwargs):
+        self._extra = None
+        self.update(data, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            if not self.is_set(key):
+                raise KeyError(key)
+            return getattr(self, key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getattr__(self, name):
+        # only called for fields whose slots were never set
+        if name in self.field_set:
+            return None
+        raise AttributeError(name)
+
+    def __contains__(self, key):
+        if key in self.field_set:
+            return self.is_set(key)
+        return bool(self._extra and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.get('id'))
+
+    def __reduce__(self):
+        # date fields that were not read are pickled as their original strings
+        return self.__class__, (self.raw_items(),)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def is_set(self, field):
+        # checks the slot itself so that date fields are not parsed and unset fields do not read as None
+        try:
+            object.__getattribute__(self, '_%s' % field if field in self.date_fields else field)
+        except AttributeError:
+            return False
+        return True
+
+    def keys(self):
+        return [field for field in self.fields if self.is_set(field)] + list(self._extra or ())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def raw_items(self):
+        return {
+            key: getattr(self, '_%s' % key) if key in self.date_fields else self[key]
+            for key in self.keys()
+        }
+
+    def update(self, data=(), **kwargs):
+        if hasattr(data, 'items'):
+            data = data.items()
+        for key, value in data:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+
+class Credit(Record):
+    fields = (
+        'id', 'amount', 'prison', 'prisoner_number', 'prisoner_name', 'intended_recipient',
+        'sender_name', 'sender_email', 'short_payment_ref', 'anonymous', 'comments', 'reviewed',
+        'resolution', 'owner', 'owner_name', 'nomis_transaction_id',
+        'received_at', 'credited_at', 'refunded_at', 'set_manual_at', 'logged_at', 'created',
+        'new_location',
+    )
+    date_fields = ('received_at', 'credited_at', 'refunded_at', 'set_manual_at', 'logged_at', 'created')
+
+
+class Disbursement(Record):
+    fields = (
+        'id', 'amount', 'method', 'prison', 'prisoner_number', 'prisoner_name',
+        'recipient_first_name', 'recipient_last_name', 'recipient_company_name', 'recipient_is_company',
+        'recipient_email', 'address_line1', 'address_line2', 'city', 'postcode', 'country',
+        'sort_code', 'account_number', 'roll_number', 'remittance_description',
+        'resolution', 'nomis_transaction_id', 'invoice_number', 'log_set', 'created', 'modified',
+        # viability
+        'insufficient_funds', 'prisoner_moved', 'self_own', 'editable', 'confirmable', 'viable',
+        'confirmable_by_other',
+    )
+    date_fields = ('created', 'modified')
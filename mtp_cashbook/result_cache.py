@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from mtp_common.auth.api_client import MoJOAuth2Session
+
+logger = logging.getLogger('mtp')
+
+
+def get_generation_cache_key(user):
+    return 'result-cache-generation-%s' % user.pk
+
+
+def get_generation(user, renew=False):
+    """
+    Results are cached under a per-user generation so that all of a user's results can be dropped at once
+    """
+    cache_key = get_generation_cache_key(user)
+    generation = None if renew else cache.get(cache_key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(cache_key, generation, timeout=None)
+    return generation
+
+
+def get_result_cache_key(user, name, filters, page):
+    filters = '&'.join(
+        '%s=%s' % (key, value)
+        for key, value in sorted(filters.items())
+        if value not in (None, '', [])
+    )
+    digest = hashlib.sha1(('%s?%s&page=%s' % (name, filters, page)).encode()).hexdigest()
+    return 'result-cache-%s-%s-%s' % (user.pk, get_generation(user), digest)
+
+
+def get_cached_results(user, name, filters, page):
+    """
+    Returns results cached by `cache_results` for the user's search or None
+    """
+    if not settings.RESULT_CACHE_TTL:
+        return None
+    return cache.get(get_result_cache_key(user, name, filters, page))
+
+
+def cache_results(user, name, filters, page, results):
+    """
+    Keeps a page of api search results for RESULT_CACHE_TTL seconds so that paging back and forth
+    or returning to a search does not repeat api queries
+    """
+    if settings.RESULT_CACHE_TTL:
+        cache.set(get_result_cache_key(user, name, filters, page), results, timeout=settings.RESULT_CACHE_TTL)
+
+
+def invalidate_cached_results(user):
+    """
+    Call after anything the user does that changes search results, such as once crediting has finished;
+    the generation is only seen by other processes if the cache is shared
+    """
+    get_generation(user, renew=True)
+
+
+prefetch_lock = threading.Lock()
+prefetch_executor = None
+
+
+def get_prefetch_executor():
+    # threads are only started when first needed so that forked uWSGI workers do not share them
+    global prefetch_executor
+    with prefetch_lock:
+        if prefetch_executor is None:
+            prefetch_executor = ThreadPoolExecutor(max_workers=max(1, settings.RESULT_PREFETCH_WORKERS))
+        return prefetch_executor
+
+
+def prefetch_results(request, name, filters, page, retrieve):
+    """
+    If RESULT_PREFETCH is enabled, loads a page of results that is likely to be requested next
+    in the background once the response has been sent and caches it like `cache_results`;
+    `retrieve` is called with a `session` keyword argument as the request's api session cannot be used
+    """
+    if not settings.RESULT_PREFETCH or not settings.RESULT_CACHE_TTL:
+        return
+    cache_key = get_result_cache_key(request.user, name, filters, page)
+    if cache.get(cache_key) is not None:
+        return
+    # the token is not refreshed in the background because the refreshed token could not be saved
+    # into the request's session after the response and the previous refresh token would stop working
+    token = dict(request.user.token)
+
+    def prefetch():
+        try:
+            results = retrieve(session=MoJOAuth2Session(settings.API_CLIENT_ID, token=token))
+        except Exception:
+            logger.exception('Could not prefetch page %s of %s' % (page, name))
+            return
+        cache.set(cache_key, results, timeout=settings.RESULT_CACHE_TTL)
+
+    if not hasattr(request, 'result_prefetches'):
+        request.result_prefetches = []
+    request.result_prefetches.append(prefetch)
+
+
+def start_prefetches(request, response):
+    """
+    Submits prefetches queued by `prefetch_results` when the response is closed
+    so that they do not compete with rendering or sending it
+    """
+    prefetches = getattr(request, 'result_prefetches', None)
+    if not prefetches:
+        return response
+    close = response.close
+
+    def close_and_prefetch():
+        close()
+        executor = get_prefetch_executor()
+        for prefetch in prefetches:
+            executor.submit(prefetch)
+
+    response.close = close_and_prefetch
+    return response
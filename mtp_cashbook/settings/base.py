@@ -2,6 +2,7 @@ from functools import partial
 import os
 from os.path import abspath, dirname, join
 import sys
+import tempfile
 from urllib.parse import urljoin
 
 BASE_DIR = dirname(dirname(abspath(__file__)))
@@ -100,12 +101,27 @@ CSRF_FAILURE_VIEW = 'mtp_common.auth.csrf.csrf_failure'
 
 # Data stores
 DATABASES = {}
+# set to a backend shared by all web and spooler processes, such as memcached, so that cached values
+# can be invalidated from any process; the default local memory cache is separate in each process
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'mtp',
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'mtp'),
     }
 }
+# values that other processes need to invalidate are only cached between requests in a shared cache
+SHARED_CACHE = CACHE_BACKEND != 'django.core.cache.backends.locmem.LocMemCache'
+# crediting progress is counted where both web and spooler processes can see it: in the cache if it is shared,
+# otherwise in files in this directory on the host that runs them both
+CREDITING_PROGRESS_LOCATION = os.environ.get(
+    'CREDITING_PROGRESS_LOCATION', os.path.join(tempfile.gettempdir(), 'mtp-cashbook-progress')
+)
+CACHES['progress'] = CACHES['default'] if SHARED_CACHE else {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': CREDITING_PROGRESS_LOCATION,
+    'OPTIONS': {'MAX_ENTRIES': 10000},
+}
 
 
 # Internationalization
@@ -237,6 +253,8 @@ LOGOUT_URL = 'logout'
 OAUTHLIB_INSECURE_TRANSPORT = True
 
 REQUEST_PAGE_SIZE = 100
+# number of following pages requested at the same time when loading all pages of an api list
+REQUEST_PAGE_PREFETCH = int(os.environ.get('REQUEST_PAGE_PREFETCH', '4'))
 
 ANALYTICS_REQUIRED = os.environ.get('ANALYTICS_REQUIRED', 'True') == 'True'
 GOOGLE_ANALYTICS_ID = os.environ.get('GOOGLE_ANALYTICS_ID', None)
@@ -260,6 +278,29 @@ HMPPS_CLIENT_SECRET = os.environ.get('HMPPS_CLIENT_SECRET', '')
 HMPPS_AUTH_BASE_URL = os.environ.get('HMPPS_AUTH_BASE_URL', '')
 HMPPS_PRISON_API_BASE_URL = os.environ.get('HMPPS_PRISON_API_BASE_URL', '')
 
+# concurrent NOMIS lookups made while rendering a page: pool size and overall deadline in seconds
+NOMIS_LOOKUP_WORKERS = int(os.environ.get('NOMIS_LOOKUP_WORKERS', '10'))
+NOMIS_LOOKUP_TIMEOUT = int(os.environ.get('NOMIS_LOOKUP_TIMEOUT', '20'))
+# shared NOMIS connection pool: connections kept per process
+NOMIS_POOL_SIZE = int(os.environ.get('NOMIS_POOL_SIZE', '10'))
+# seconds that prisoner locations are cached for if the cache is shared
+NOMIS_LOCATION_CACHE_TTL = int(os.environ.get('NOMIS_LOCATION_CACHE_TTL', '60'))
+# seconds that snapshots of prisoner account balances are cached for if the cache is shared
+NOMIS_BALANCES_CACHE_TTL = int(os.environ.get('NOMIS_BALANCES_CACHE_TTL', '30'))
+# NOMIS circuit breaker: opens when NOMIS_CIRCUIT_FAILURE_RATE of at least NOMIS_CIRCUIT_MIN_CALLS calls
+# in the last NOMIS_CIRCUIT_WINDOW seconds failed or took longer than NOMIS_CIRCUIT_SLOW_CALL seconds
+# and then rejects calls for NOMIS_CIRCUIT_BACKOFF seconds, doubling up to NOMIS_CIRCUIT_MAX_BACKOFF while NOMIS fails
+NOMIS_CIRCUIT_WINDOW = int(os.environ.get('NOMIS_CIRCUIT_WINDOW', '30'))
+NOMIS_CIRCUIT_MIN_CALLS = int(os.environ.get('NOMIS_CIRCUIT_MIN_CALLS', '10'))
+NOMIS_CIRCUIT_FAILURE_RATE = float(os.environ.get('NOMIS_CIRCUIT_FAILURE_RATE', '0.5'))
+NOMIS_CIRCUIT_SLOW_CALL = float(os.environ.get('NOMIS_CIRCUIT_SLOW_CALL', '10'))
+NOMIS_CIRCUIT_BACKOFF = int(os.environ.get('NOMIS_CIRCUIT_BACKOFF', '5'))
+NOMIS_CIRCUIT_MAX_BACKOFF = int(os.environ.get('NOMIS_CIRCUIT_MAX_BACKOFF', '120'))
+# most NOMIS calls made at once per process; lowered automatically while calls fail or are slow;
+# calls wait up to NOMIS_CONCURRENCY_WAIT seconds to start before failing
+NOMIS_CONCURRENCY_LIMIT = int(os.environ.get('NOMIS_CONCURRENCY_LIMIT', '10'))
+NOMIS_CONCURRENCY_WAIT = int(os.environ.get('NOMIS_CONCURRENCY_WAIT', '30'))
+
 TOKEN_RETRIEVAL_USERNAME = os.environ.get('TOKEN_RETRIEVAL_USERNAME', '_token_retrieval')
 TOKEN_RETRIEVAL_PASSWORD = os.environ.get('TOKEN_RETRIEVAL_PASSWORD', '_token_retrieval')
 
@@ -282,6 +323,32 @@ POSTCODE_LOOKUP_AUTH_TOKEN = os.environ.get('POSTCODE_LOOKUP_AUTH_TOKEN', '')
 CLOUD_PLATFORM_MIGRATION_MODE = os.environ.get('CLOUD_PLATFORM_MIGRATION_MODE', '')
 CLOUD_PLATFORM_MIGRATION_URL = os.environ.get('CLOUD_PLATFORM_MIGRATION_URL', '')
 
+# number of new credits shown on each page; 0 shows all on one page
+NEW_CREDITS_PAGE_SIZE = int(os.environ.get('NEW_CREDITS_PAGE_SIZE', '100'))
+
+# seconds that a user's pages of search and processed credit results are cached for; 0 disables
+# as results are invalidated by crediting, which may happen in other processes, it is off without a shared cache
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '30' if SHARED_CACHE else '0'))
+# whether the next page of results is loaded into the cache in the background using this many threads per process
+RESULT_PREFETCH = os.environ.get('RESULT_PREFETCH', 'False') == 'True'
+RESULT_PREFETCH_WORKERS = int(os.environ.get('RESULT_PREFETCH_WORKERS', '2'))
+# whether processed credit batches are paged using opaque cursors on (logged_at, user) rather than page numbers
+PROCESSED_CREDITS_KEYSET_PAGINATION = os.environ.get('PROCESSED_CREDITS_KEYSET_PAGINATION', 'False') == 'True'
+# most new credits shown on the first page of search results
+SEARCH_NEW_CREDITS_LIMIT = int(os.environ.get('SEARCH_NEW_CREDITS_LIMIT', '100'))
+# number of credits in a batch that are credited to NOMIS at the same time
+CREDITING_WORKERS = int(os.environ.get('CREDITING_WORKERS', '5'))
+# spooled batches with more credits than this are split into jobs of this size for all spooler processes to share;
+# 0 disables splitting
+CREDITING_JOB_SIZE = int(os.environ.get('CREDITING_JOB_SIZE', '100'))
+# credited or manual credits are reported to the api in chunks of this size or after this many seconds
+CREDIT_UPDATES_CHUNK_SIZE = int(os.environ.get('CREDIT_UPDATES_CHUNK_SIZE', '20'))
+CREDIT_UPDATES_INTERVAL = int(os.environ.get('CREDIT_UPDATES_INTERVAL', '5'))
+# credited confirmation emails are taken from the crediting queue and spooled in batches of up to this size
+CREDITED_CONFIRMATION_BATCH_SIZE = int(os.environ.get('CREDITED_CONFIRMATION_BATCH_SIZE', '20'))
+# crediting progress is kept for this many seconds
+CREDITING_PROGRESS_TTL = int(os.environ.get('CREDITING_PROGRESS_TTL', '600'))
+
 PRISONER_CAPPING_ENABLED = bool(int(os.environ.get('PRISONER_CAPPING_ENABLED', '0')))
 PRISONER_CAPPING_THRESHOLD_IN_POUNDS = int(os.environ.get('PRISONER_CAPPING_THRESHOLD_IN_POUNDS', '900'))
 
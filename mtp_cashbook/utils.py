@@ -1,5 +1,19 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+import datetime
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from mtp_common.auth import USER_DATA_SESSION_KEY
-from mtp_common.auth.api_client import get_api_session
+from mtp_common.auth.api_client import MoJOAuth2Session, get_api_session
+from requests.exceptions import RequestException
+
+logger = logging.getLogger('mtp')
 
 
 def save_user_flags(request, flag):
@@ -10,3 +24,161 @@ def save_user_flags(request, flag):
     flags = list(flags)
     request.user.user_data['flags'] = flags
     request.session[USER_DATA_SESSION_KEY] = request.user.user_data
+
+
+def map_concurrently(func, items, *, max_workers, timeout, default=None, exceptions=(RequestException,)):
+    """
+    Calls `func` with each of `items` using a bounded pool of threads and returns results in the same order.
+    Items whose call raises one of `exceptions` or does not complete within `timeout` seconds
+    get `default` instead so that one slow or failing call does not hold up or break the rest.
+    """
+    items = list(items)
+    results = [default] * len(items)
+    if not items:
+        return results
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+    try:
+        futures = {
+            executor.submit(func, item): index
+            for index, item in enumerate(items)
+        }
+        done, not_done = wait(futures, timeout=timeout)
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except exceptions:
+                pass
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            logger.warning('%d of %d concurrent calls did not complete in time' % (len(not_done), len(items)))
+    finally:
+        # do not wait for calls that exceeded the deadline
+        executor.shutdown(wait=False)
+    return results
+
+
+def copy_api_session(session):
+    """
+    Returns a new api session with the current token of `session` for use in another thread;
+    copies never refresh the token because only the request's own session can save a refreshed token
+    so any expired token should be refreshed by using `session` before copying it
+    """
+    api_session = MoJOAuth2Session(settings.API_CLIENT_ID, token=dict(session.token))
+    api_session.headers.update(session.headers)
+    return api_session
+
+
+def refresh_api_token(api_session):
+    """
+    Refreshes the user's api token only if it has already expired, as the api session itself would;
+    the refreshed token cannot reach the user's browser so refreshing earlier would revoke the refresh token
+    that their web session still holds
+    """
+    expires_at = api_session.token.get('expires_at')
+    if not expires_at or expires_at > time.time():
+        return
+    token = api_session.refresh_token(api_session.auto_refresh_url, **api_session.auto_refresh_kwargs)
+    api_session.token_updater(token)
+
+
+def iterate_all_pages(session, path, **params):
+    """
+    Yields results from all pages of a paginated api list like `mtp_common.api.retrieve_all_pages_for_path`
+    but without first building one list; once the first page reveals the count,
+    up to REQUEST_PAGE_PREFETCH following pages are requested concurrently while earlier results are consumed.
+    Following pages are requested by threads with their own copy of the api session
+    """
+    page_size = getattr(settings, 'REQUEST_PAGE_SIZE', 20)
+    thread_local = threading.local()
+
+    def get_page(page_session, offset):
+        return page_session.get(path, params=dict(limit=page_size, offset=offset, **params)).json()
+
+    # an expired token is refreshed by the request's session here, in the request's thread
+    page = get_page(session, 0)
+    yield from page.get('results', [])
+    offsets = iter(range(page_size, page.get('count', 0), page_size))
+    # copied once the token is up to date and then copied again by each thread
+    thread_session = copy_api_session(session)
+
+    def start_thread():
+        thread_local.session = copy_api_session(thread_session)
+
+    def get_following_page(offset):
+        return get_page(thread_local.session, offset)
+
+    prefetch = max(1, settings.REQUEST_PAGE_PREFETCH)
+    executor = ThreadPoolExecutor(max_workers=prefetch, initializer=start_thread)
+    pages = collections.deque(
+        executor.submit(get_following_page, offset)
+        for offset in itertools.islice(offsets, prefetch)
+    )
+    try:
+        while pages:
+            page = pages.popleft().result()
+            offset = next(offsets, None)
+            if offset is not None:
+                pages.append(executor.submit(get_following_page, offset))
+            yield from page.get('results', [])
+    finally:
+        # pages are not needed if iteration stops early
+        for future in pages:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def parse_date_value(value):
+    """
+    Parses an ISO-8601 date or date/time string as returned by the MTP API
+    falling back to django's more lenient parsers for other formats
+    """
+    try:
+        if len(value) == 10:
+            return datetime.date.fromisoformat(value)
+        if value[-1] in 'Zz':
+            value = value[:-1] + '+00:00'
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    return parse_datetime(value) or parse_date(value)
+
+
+class DateFieldParser:
+    """
+    Converts MTP API string date/time fields of records into python objects in place;
+    date/times are converted to the current timezone which is looked up once per list of records
+    and repeated values are parsed only once
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+    def iterate(self, records):
+        time_zone = timezone.get_current_timezone()
+        parsed_values = {}
+        fields = self.fields
+        for record in records:
+            for field in fields:
+                value = record.get(field)
+                if not value or not isinstance(value, str):
+                    continue
+                try:
+                    record[field] = parsed_values[value]
+                    continue
+                except KeyError:
+                    pass
+                try:
+                    parsed_value = parse_date_value(value)
+                    if isinstance(parsed_value, datetime.datetime):
+                        parsed_value = timezone.localtime(parsed_value, time_zone)
+                except (ValueError, TypeError):
+                    # unparseable and naive values are left unchanged
+                    parsed_value = value
+                parsed_values[value] = parsed_value or value
+                record[field] = parsed_values[value]
+            yield record
+
+    def parse(self, records):
+        return list(self.iterate(records))